@@ -5,7 +5,8 @@ from .basic_crud import BasicCRUD
 from .exceptions import *  # noqa
 from .grants import Grants
 from .metrics import Metrics
-from .ratelimit import RateLimit
+from .profile_cache import ProfileCache
+from .ratelimit import ClientLimit, RateLimit
 from .service_config import ServiceConfig
 from .service_registry import ServiceRegistry
 from .session_auth import SessionAuth
@@ -13,6 +14,6 @@ from .session_manager import SessionManager, Mutex
 from .trashcan import Trashcan
 
 __all__ = ('AccessControl', 'AccountSettings', 'AESEncrypt', 'AESEncryptBin',
-           'BasicCRUD', 'Grants', 'Metrics', 'Mutex', 'RateLimit',
-           'ServiceConfig', 'ServiceRegistry', 'SessionAuth', 'SessionManager',
-           'Trashcan')
+           'BasicCRUD', 'ClientLimit', 'Grants', 'Metrics', 'Mutex',
+           'ProfileCache', 'RateLimit', 'ServiceConfig', 'ServiceRegistry',
+           'SessionAuth', 'SessionManager', 'Trashcan')
@@ -7,6 +7,7 @@ refactored 6-mar-2020
 from base64 import b64encode
 from datetime import timedelta
 from flask import g, request
+from functools import lru_cache
 from flask_babel import _
 import hashlib
 import logging
@@ -74,78 +75,122 @@ class AccessControl(object):
     def __init__(self, policy_file=None, model=None):
         if POLICIES and request:
             self.policies = POLICIES['policies']
+            self.rules = POLICIES['rules']
             self.privacy_levels = LEVELS['levels']
             self.private_res = state.private_res
             self.model = model
             self.models = ServiceConfig().models
             self.resource = model.__name__.lower() if model else None
-            self.auth = self.auth_method = None
-            header_auth = ServiceConfig().config.HEADER_AUTH_APIKEY
-            self.apikey_id = None
-            if header_auth in request.headers:
-                # TODO: add support for HMAC request signing in place
-                # of this plain-text X-Api-Key header method
-                try:
-                    prefix, secret = request.headers.get(
-                        header_auth).split('.')
-                except ValueError:
-                    item = None
-                else:
-                    item = g.session.get(None, self.apikey_hash(secret)[:8],
-                                         key_id=prefix)
-                if item:
-                    self.auth = item.get('auth').split(':')
-                    self.uid = uid = item.get('sub')
-                    self.apikey_id = prefix
-            elif request.authorization:
-                uid = self.uid = request.authorization.username
-                secret = request.authorization.password
-                try:
-                    self.auth = g.session.get(
-                        uid, secret, arg='auth').split(':')
-                except AttributeError:
-                    pass
+            self._rbac_cache = {}
             self.primary_resource = self.private_res[0]['resource']
-            self.auth_ids = {self.primary_resource: []}
-            if self.auth:
-                for role in self.auth:
-                    ev = self._parse_id(role, self.primary_resource)
-                    if ev:
-                        self.auth_ids[self.primary_resource].append(ev)
-                self.account_id = g.session.get(uid, secret, 'acc')
-                self.auth_method = g.session.get(uid, secret, 'method')
-                self.identity = g.session.get(uid, secret, 'identity')
+            for key, value in self._session_context().items():
+                setattr(self, key, value)
+
+    def _session_context(self):
+        """Resolve the caller's session from the API-key header or
+        basic-auth credentials. The decoded session is memoized on
+        flask.g so that each AccessControl object constructed during a
+        request is a cheap view over a single lookup.
+
+        Returns:
+          dict: auth, auth_ids, auth_method, account_id, apikey_id,
+            identity and uid attributes
+        """
+        header_auth = ServiceConfig().config.HEADER_AUTH_APIKEY
+        if header_auth in request.headers:
+            creds = (header_auth, request.headers.get(header_auth))
+        elif request.authorization:
+            creds = (request.authorization.username,
+                     request.authorization.password)
+        else:
+            creds = None
+        contexts = g.setdefault('access_contexts', {})
+        if creds in contexts:
+            return contexts[creds]
+        context = dict(auth=None, auth_method=None, apikey_id=None,
+                       auth_ids={self.primary_resource: []})
+        session = None
+        if creds and creds[0] == header_auth:
+            # TODO: add support for HMAC request signing in place
+            # of this plain-text X-Api-Key header method
+            try:
+                prefix, secret = creds[1].split('.')
+            except ValueError:
+                pass
             else:
-                # For anonymous-access paths that don't require security
-                self.uid = self.account_id = self.identity = None
+                session = g.session.get(None, self.apikey_hash(secret)[:8],
+                                        key_id=prefix)
+                if session:
+                    context['apikey_id'] = prefix
+        elif creds:
+            session = g.session.get(*creds)
+        if session and session.get('auth'):
+            context['auth'] = session['auth'].split(':')
+            for role in context['auth']:
+                ev = self._parse_id(role, self.primary_resource)
+                if ev:
+                    context['auth_ids'][self.primary_resource].append(ev)
+            context.update(uid=session.get('sub'),
+                           account_id=session.get('acc'),
+                           auth_method=session.get('method'),
+                           identity=session.get('identity'))
+            contexts[creds] = context
+        else:
+            # For anonymous-access paths that don't require security
+            context.update(uid=None, account_id=None, identity=None)
+        return context
 
     def load_rbac(self, filename):
         """ Read RBAC default policies from rbac.yaml, process any
         string substitutions, and convert * for re.match()
 
+        The policies are also compiled into a decision structure,
+        indexed by resource and then by principal: principals without
+        runtime keywords (such as admin) are looked up directly by role
+        name, and resource patterns without runtime keywords are
+        compiled once here rather than upon each evaluation.
+
         Args:
           filename (str): filename containing RBAC definitions
         """
 
         with open(filename, 'rt', encoding='utf8') as f:
             rbac = yaml.safe_load(f)
-            self.policies = {}
+        self.policies, self.rules = {}, {}
         for res, policy in rbac['policies'].items():
             self.policies[res] = []
+            rules = self.rules[res] = dict(
+                defaults=None, principals={}, templated=[])
             for item in policy:
-                self.policies[res].append(dict(
+                entry = dict(
                     principal=item['principal'].format(
                     ).replace('*', '.*'),
                     resource=item['resource'].format(
                         resource=res).replace('*', '.*'),
-                    actions=set(list(item['actions']))))
-                self.privacy_levels = rbac['privacy_levels']
-                self.private_res = rbac.get(
-                    'private_resources', [
-                        dict(resource='list', attr='list_id')])
-                LEVELS['levels'] = self.privacy_levels
-                POLICIES['policies'] = self.policies
-                state.private_res = self.private_res
+                    actions=set(list(item['actions'])))
+                self.policies[res].append(entry)
+                if entry['principal'] == '.*':
+                    rules['defaults'] = entry['actions']
+                    continue
+                # TODO match_id is a bit hacky, should format str
+                rule = dict(
+                    entry, match=('uid' if 'uid' in entry['resource'] else
+                                  'eid' if 'eid' in entry['resource']
+                                  else None),
+                    regex=(None if '{' in entry['resource'] else
+                           _resource_regex(entry['resource'])))
+                if '{' in entry['principal']:
+                    rules['templated'].append(rule)
+                else:
+                    rules['principals'].setdefault(
+                        entry['principal'], []).append(rule)
+        self.privacy_levels = rbac['privacy_levels']
+        self.private_res = rbac.get(
+            'private_resources', [dict(resource='list', attr='list_id')])
+        LEVELS['levels'] = self.privacy_levels
+        POLICIES['policies'] = self.policies
+        POLICIES['rules'] = self.rules
+        state.private_res = self.private_res
 
     def with_permission(self, access, query=None, new_uid=None,
                         membership=None, id=None):
@@ -235,6 +280,7 @@ class AccessControl(object):
         """
         # logging.info(dict(step=3, owner_uid=owner_uid, membership=membership,
         #                   id=id, privacy=privacy))
+        record = None
         if query:
             try:
                 record = query.one()
@@ -255,13 +301,13 @@ class AccessControl(object):
         # TODO improve schema or yaml syntax to handle these special-cases
         # TODO make the contact find function return correct rbac
         deny_delete = set()
-        if query and self.resource == 'contact':
+        if record and self.resource == 'contact':
             if self.uid and self.uid != owner_uid:
-                owner_uid = query.one().owner.referrer_id or owner_uid
+                owner_uid = record.owner.referrer_id or owner_uid
             # TODO redesign fragile dependency on primary contact
             try:
                 g.db.query(self.models.Person).filter_by(
-                    identity=query.one().info).one()
+                    identity=record.info).one()
                 deny_delete = set('d')
             except NoResultFound:
                 pass
@@ -270,8 +316,101 @@ class AccessControl(object):
         #                   id=id, privacy=privacy, auth=self.auth,
         #                   resource=self.resource))
 
+        actions, defaults = self._evaluate(owner_uid, membership, id, privacy)
+        actions = actions - deny_delete
+        # logging.info(dict(step=5, id=id, actions=actions))
+        return set(actions if len(actions) else defaults)
+
+    def rbac_permissions_bulk(self, records, by_id=True):
+        """Evaluate permissions for a page of records in a single pass,
+        for list endpoints. Records which share the same owner, privacy
+        and membership id are evaluated once, and the contact special
+        cases (referrer and primary identity) are resolved with one
+        query for the whole page rather than one query per record.
+
+        Args:
+          records (list of dict): records as returned by as_dict()
+          by_id (bool): evaluate membership against the record's own id
+            if it has no private-resource attribute, as find() does;
+            set False to match rbac_permissions(query=...)
+
+        Returns:
+          list of str: sorted actions (other than create) for each record
+        """
+        attr = self.private_res[0]['attr']
+        owners = []
+        for record in records:
+            if 'uid' in record:
+                owners.append(record['uid'])
+            elif 'referrer_id' in record:
+                owners.append(record['referrer_id'] or record.get('id'))
+            else:
+                owners.append(None)
+
+        # TODO redesign fragile dependency on primary contact
+        identities, referrers = set(), {}
+        if self.resource == 'contact' and records:
+            Person = self.models.Person
+            for person in g.db.query(
+                    Person.id, Person.referrer_id, Person.identity).filter(
+                        or_(Person.id.in_(set(owners)),
+                            Person.identity.in_(set(
+                                record.get('info') for record in records)))):
+                identities.add(person.identity)
+                referrers[person.id] = person.referrer_id
+
+        retval = []
+        for record, owner_uid in zip(records, owners):
+            deny_delete = set()
+            if self.resource == 'contact':
+                if self.uid and self.uid != owner_uid:
+                    owner_uid = referrers.get(owner_uid) or owner_uid
+                if record.get('info') in identities:
+                    deny_delete = set('d')
+            id = record[attr] if attr in record else (
+                record.get('id') if by_id else None)
+            actions, defaults = self._evaluate(
+                owner_uid, self.primary_resource if id else None, id,
+                record.get('privacy'))
+            actions = actions - deny_delete
+            retval.append(''.join(sorted(list(
+                (actions if len(actions) else defaults) - set('c')))))
+        return retval
+
+    def _evaluate(self, owner_uid, membership, id, privacy):
+        """Evaluate the compiled policies for self.resource against
+        self.auth roles. Results are memoized for the lifetime of this
+        object, so a listing whose records share the same owner,
+        membership and privacy costs one evaluation rather than a
+        full policy scan per record.
+
+        The resource id only affects the result if it appears in one
+        of the principal's roles, or matches the owner or current uid;
+        otherwise it's left out of the memo key.
+
+        Args:
+          owner_uid (str): owner-uid of a record
+          membership (str): resource type which defines membership privacy
+          id (str): the resource ID if membership is set
+          privacy (str): privacy setting of the record
+
+        Returns:
+          tuple: frozensets of actions matched and default actions
+        """
+        if id and (id in (self.uid, owner_uid) or (self.auth and any(
+                str(id) in role for role in self.auth))):
+            id_key = id
+        else:
+            id_key = bool(id)
+        key = (owner_uid, membership, id_key, privacy)
+        if key in self._rbac_cache:
+            return self._rbac_cache[key]
+
+        rules = self.rules[self.resource]
         actions, defaults = (set(), set())
-        if privacy == 'public' or (
+        if rules['defaults'] is not None:
+            defaults = rules['defaults']
+        elif privacy == 'public' or (
                 self.auth and id and '%s-%s-%s' % (membership, id, privacy)
                 in self.auth):
             # TODO this needs another check that the current resource's
@@ -279,41 +418,32 @@ class AccessControl(object):
             # membership and id (which is, say, an event-id)
             defaults = set('r')
 
-        for policy in self.policies[self.resource]:
-            if policy['principal'] == '.*':
-                defaults = set(list(policy['actions']))
-            elif self.auth:
-                for role in self.auth:
-                    if role in ('person', 'user'):
-                        role += '/{uid}'
-                    match_id = None
-                    # TODO match_id is a bit hacky, should format str
-                    if 'uid' in policy['resource']:
-                        match_id = self.uid
-                    elif 'eid' in policy['resource']:
-                        match_id = id
-
+        if self.auth:
+            params = dict(eid=id, list_id=id, uid=owner_uid)
+            for role in self.auth:
+                if role in ('person', 'user'):
+                    role += '/{uid}'
+                role = role.format(eid=id, list_id=id, uid=self.uid)
+                candidates = rules['principals'].get(role, []) + [
+                    rule for rule in rules['templated']
+                    if rule['principal'].format(**params) == role]
+                # special-case for person/contact principal:<res>-*
+                if role.split('-')[0] == membership:
+                    candidates += rules['principals'].get(
+                        '%s-*' % membership, [])
+                for rule in candidates:
+                    if rule['actions'] <= actions:
+                        continue
+                    match_id = (self.uid if rule['match'] == 'uid' else
+                                id if rule['match'] == 'eid' else None)
                     # TODO fix the wildcard matching
-                    if (policy['principal'].format(eid=id, list_id=id,
-                                                   uid=owner_uid) ==
-                        role.format(eid=id, list_id=id, uid=self.uid) and
-                        re.match(
-                            '^%s$' % policy['resource'].format(
-                                eid=id, list_id=id, uid=owner_uid),
-                            '%s:%s' % (self.resource, match_id))):
-                        actions |= policy['actions']
-
-                    # special-case for person/contact principal:<res>-*
-                    elif (policy['principal'] == '%s-*' % membership and
-                          role.split('-')[0] == membership and
-                          re.match(
-                              '^%s$' % policy['resource'].format(
-                                  eid=id, list_id=id, uid=owner_uid),
-                              '%s:%s' % (self.resource, match_id))):
-                        actions |= policy['actions']
-        actions -= deny_delete
-        # logging.info(dict(step=5, id=id, actions=actions))
-        return actions if len(actions) else defaults
+                    regex = rule['regex'] or _resource_regex(
+                        rule['resource'].format(**params))
+                    if regex.match('%s:%s' % (self.resource, match_id)):
+                        actions |= rule['actions']
+        retval = self._rbac_cache[key] = (frozenset(actions),
+                                          frozenset(defaults))
+        return retval
 
     def apikey_create(self):
         """Generate an API key - a 41-byte string. First 8 characters (48
@@ -383,3 +513,16 @@ class AccessControl(object):
         x = role.split('-')
         if x and x[0] == resource:
             return '-'.join(x[1:-1])
+
+
+@lru_cache(maxsize=1024)
+def _resource_regex(pattern):
+    """Compile a resource pattern into an anchored regex - memoized,
+    since most patterns differ only by a handful of owner uids
+
+    Args:
+      pattern (str): resource pattern after keyword substitution
+    Returns:
+      obj: compiled regex
+    """
+    return re.compile('^%s$' % pattern)
@@ -5,10 +5,13 @@ created 13-may-2019 by richb@instantlinux.net
 
 from cachetools import TTLCache
 from collections import namedtuple
+import functools
 import logging
-from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy_utils.types.encrypted.padding import InvalidPaddingError
+from sqlalchemy import and_
+from sqlalchemy.orm import aliased
+import threading
 
+from .profile_cache import ProfileCache
 from .service_config import ServiceConfig
 
 
@@ -20,7 +23,8 @@ class AccountSettings(object):
     class provides access to these key-value pairs as read-only
     attributes. Because these functions are called frequently, the db
     entry is loaded into memory for a configurable expiration period
-    (config.REDIS_TTL).
+    (config.REDIS_TTL) as an immutable object, using a single joined
+    query on a cache miss.
 
     Args:
       account_id (str): ID in database of a user's account
@@ -29,69 +33,26 @@ class AccountSettings(object):
     """
     _singleton = None
     _cache = None
+    _lock = threading.Lock()
     _admin_id = None
 
     def __init__(self, account_id, db_session=None, uid=None):
         """Cache per-account settings and convert to attributes"""
 
-        def _convert(attrs):
-            return namedtuple('GenericDict', attrs.keys())(**attrs)
-
         config = ServiceConfig().config
-        models = self.models = ServiceConfig().models
-        if account_id not in self._cache:
-            try:
-                if account_id:
-                    account = db_session.query(models.Account).filter_by(
-                        id=account_id).one()
-                    uid = account.uid
-                else:
-                    account = db_session.query(models.Account).filter_by(
-                        uid=uid).one()
-                    account_id = account.id
-                record = account.settings
-            except NoResultFound:
-                if self._admin_id:
-                    # Already cached
-                    return self.__init__(self._admin_id, db_session=db_session)
-                try:
-                    record = db_session.query(models.Settings).filter_by(
-                        name='global').one()
-                    account = db_session.query(models.Account).filter_by(
-                        uid=record.administrator_id).one()
-                except Exception as ex:
-                    logging.error(dict(action='AccountSettings',
-                                       error=str(ex)))
-                    return None
-                uid = record.administrator_id
-                self._admin_id = account_id = account.id
-            except InvalidPaddingError as ex:
-                logging.error(dict(action='AccountSettings', error=str(ex)))
+        self.models = ServiceConfig().models
+        with self._lock:
+            entry = self._cache.get(account_id or uid)
+        if not entry:
+            entry = self._load(account_id, db_session, uid=uid)
+            if not entry:
                 return None
-            try:
-                category_id = db_session.query(models.Category).filter_by(
-                    uid=uid).filter_by(name='default').one().id
-            except NoResultFound:
-                category_id = record.default_cat_id
-            self._cache[account_id] = dict(
-                uid=uid,
-                settings=dict(
-                    record.as_dict(), **dict(
-                        category_id=category_id,
-                        sender_name=record.administrator.name,
-                        sender_email=record.administrator.identity,
-                        tz=record.tz.name)))
-            try:
-                senders = db_session.query(models.List).filter_by(
-                    name=config.APPROVED_SENDERS,
-                    uid=record.administrator_id).one()
-                self._cache[account_id]['settings']['approved_senders'] = (
-                    [member.identity for member in senders.members])
-            except NoResultFound:
-                self._cache[account_id]['settings']['approved_senders'] = []
-        self.get = _convert(self._cache[account_id]['settings'])
-        self.account_id = account_id
-        self.uid = self._cache[account_id]['uid']
+            with self._lock:
+                self._cache[entry.account_id] = self._cache[
+                    entry.uid] = entry
+        self.get = entry.settings
+        self.account_id = entry.account_id
+        self.uid = entry.uid
         self.db_session = db_session
         self.default_locale = config.BABEL_DEFAULT_LOCALE
 
@@ -105,16 +66,108 @@ class AccountSettings(object):
 
     def uncache(self):
         """Clear the cached settings for account_id"""
-        self._cache.pop(self.account_id, None)
+        with self._lock:
+            entry = self._cache.pop(self.account_id, None)
+            if entry:
+                self._cache.pop(entry.uid, None)
 
     @property
     def locale(self):
         """Returns the language for the uid if specified in the
         user's profile
         """
+        if not self.db_session:
+            return None
+        return ProfileCache(self.db_session).get(self.uid, 'lang')
+
+    def _load(self, account_id, db_session, uid=None):
+        """Load settings of an account, falling back to the global
+        settings of the administrator if the account isn't found
+
+        Args:
+          account_id (str): ID in database of a user's account
+          db_session (obj): a session connected to database
+          uid (str): User ID, if account_id isn't known
+        Returns:
+          _Entry: cache entry, or None if no settings are found
+        """
+        models = self.models
         try:
-            return self.db_session.query(self.models.Profile).filter(
-                self.models.Profile.uid == self.uid,
-                self.models.Profile.item == 'lang').one().value
-        except (NoResultFound, AttributeError):
+            rows = self._query(db_session, and_(
+                models.Account.settings_id == models.Settings.id,
+                models.Account.id == account_id if account_id else
+                models.Account.uid == uid))
+            if not rows:
+                with self._lock:
+                    admin_id = self._admin_id
+                    entry = self._cache.get(admin_id) if admin_id else None
+                if admin_id:
+                    # Already cached
+                    return entry or self._load(admin_id, db_session)
+                rows = self._query(db_session, and_(
+                    models.Settings.name == 'global',
+                    models.Account.uid == models.Settings.administrator_id))
+                if not rows:
+                    raise LookupError('global settings not found')
+                with self._lock:
+                    AccountSettings._admin_id = rows[0][0]
+        except Exception as ex:
+            logging.error(dict(action='AccountSettings', error=str(ex)))
             return None
+        account_id, uid, record, sender_name, sender_email, tz, \
+            category_id = rows[0][:7]
+        settings = dict(
+            record.as_dict(), category_id=category_id or record.default_cat_id,
+            sender_name=sender_name, sender_email=sender_email, tz=tz,
+            approved_senders=frozenset(
+                row[7] for row in rows if row[7] is not None))
+        return _Entry(account_id=account_id, uid=uid,
+                      settings=_settings_type(tuple(settings))(**settings))
+
+    def _query(self, db_session, account_filter):
+        """Fetch an account's settings record along with its default
+        category, administrator and approved senders in one query
+
+        Args:
+          db_session (obj): a session connected to database
+          account_filter (obj): join condition between account and settings
+        Returns:
+          list: rows of (account_id, uid, settings, sender_name,
+            sender_email, tz, category_id, approved_sender), one
+            per approved sender
+        """
+        models = self.models
+        admin = aliased(models.Person)
+        member = aliased(models.Person)
+        return db_session.query(
+            models.Account.id, models.Account.uid, models.Settings,
+            admin.name, admin.identity, models.Tz.name,
+            models.Category.id, member.identity).join(
+                models.Settings, account_filter).join(
+                admin, admin.id == models.Settings.administrator_id).join(
+                models.Tz, models.Tz.id == models.Settings.tz_id).outerjoin(
+                models.Category, and_(
+                    models.Category.uid == models.Account.uid,
+                    models.Category.name == 'default')).outerjoin(
+                models.List, and_(
+                    models.List.uid == models.Settings.administrator_id,
+                    models.List.name ==
+                    ServiceConfig().config.APPROVED_SENDERS)).outerjoin(
+                models.ListMember,
+                models.ListMember.list_id == models.List.id).outerjoin(
+                member, member.id == models.ListMember.uid).all()
+
+
+_Entry = namedtuple('_Entry', ('account_id', 'uid', 'settings'))
+
+
+@functools.lru_cache(maxsize=16)
+def _settings_type(fields):
+    """Immutable settings class, built once per set of field names
+
+    Args:
+      fields (tuple): attribute names
+    Returns:
+      type: a namedtuple class, whose instances use no per-instance dict
+    """
+    return namedtuple('Settings', fields)
@@ -4,16 +4,21 @@ created 31-mar-2019 by richb@instantlinux.net
 """
 
 import base64
+from cachetools import TTLCache
 from connexion import NoContent
 from datetime import datetime, timedelta
 from flask import g, request
 from flask_babel import _
+import hashlib
 import json
 import logging
 import re
-from sqlalchemy import asc, desc
+from sqlalchemy import and_, asc, DateTime, desc, func, inspect, select, \
+    tuple_
 from sqlalchemy.exc import IntegrityError, InvalidRequestError
+from sqlalchemy.orm import joinedload, noload, selectinload
 from sqlalchemy.orm.exc import NoResultFound
+import threading
 
 from .access import AccessControl
 from .account_settings import AccountSettings
@@ -39,9 +44,14 @@ class BasicCRUD(object):
     Args:
       resource (str): a resource name (endpoint prefix)
       model (obj): the model corresponding to the resource
+      eager_load (bool): whether find() should fetch related records
+        (owner, category, members) along with the results; set False
+        to fall back to lazy loading
     """
+    _counts = None
+    _lock = threading.Lock()
 
-    def __init__(self, resource=None, model=None):
+    def __init__(self, resource=None, model=None, eager_load=True):
         self.models = state.models
         self.resource = resource
         if self.resource not in state.controllers:
@@ -49,6 +59,7 @@ class BasicCRUD(object):
                 self.model = model
             else:
                 self.model = getattr(self.models, resource.capitalize())
+            self.eager_load = eager_load
             state.controllers[self.resource] = self
 
     @staticmethod
@@ -100,13 +111,9 @@ class BasicCRUD(object):
         ret_info = {}
         logging.info(dict(id=id, name=body.get('name'), **logmsg))
         if not body.get('category_id') and hasattr(self.model, 'category_id'):
-            if acc.account_id:
-                body['category_id'] = AccountSettings(
-                    acc.account_id, g.db).get.category_id
-            elif body.get('event_id'):
-                body['category_id'] = g.db.query(self.models.Event).filter_by(
-                    id=body['event_id']).one().category_id
-            else:
+            body['category_id'] = self._default_category(
+                acc, event_id=body.get('event_id'))
+            if not body['category_id']:
                 logging.warning(dict(message='unexpected no creds', **logmsg))
                 return dict(message=_(u'access denied')), 403
         if hasattr(self.model, 'status'):
@@ -142,12 +149,24 @@ class BasicCRUD(object):
         except (AttributeError, TypeError) as ex:
             logging.warning(dict(message=str(ex), **logmsg))
             return dict(message=str(ex)), 405
-        g.db.add(record)
         try:
+            for related, records in (related_items or {}).items():
+                missing = self._missing_related(related, records)
+                if missing:
+                    logging.warning(dict(message='not found', field=related,
+                                         ids=missing, **logmsg))
+                    return dict(message=_(u'not found'), ids=missing), 404
+            g.db.add(record)
             if related_items:
-                g.db.commit()
+                # Record and associations are committed together
+                g.db.flush()
                 for related, records in related_items.items():
-                    self._update_related(id, related, records)
+                    ret = self._update_related(id, related, records)
+                    if ret[1] != 200:
+                        g.db.rollback()
+                        logging.warning(dict(message=ret[0]['message'],
+                                             field=related, **logmsg))
+                        return ret
             g.db.commit()
         except IntegrityError as ex:
             message = 'duplicate or other conflict'
@@ -157,6 +176,131 @@ class BasicCRUD(object):
             return db_abort(str(ex), rollback=True, **logmsg)
         return dict(id=id, **ret_info), 201
 
+    @staticmethod
+    def create_many(body, id_prefix='x-'):
+        """Controller for bulk POST endpoints. Each item is validated
+        as in create(); permissions are evaluated once per distinct
+        owner, the grant limit is checked once against the size of
+        the batch, and valid items are inserted in a single transaction:
+        if the insert hits a conflict (such as a duplicate), none of the
+        items are created and the 405 response says so.
+
+        Args:
+          body (list): resources as defined by openapi.yaml schema
+          id_prefix (str): prefix for generated object IDs
+        Returns:
+          tuple:
+            first element is a dict with per-item results (id or
+            message, and status) and count of records created; second
+            element is response code (201 if any were created)
+        """
+
+        self = state.controllers[request.url_rule.rule.split('/')[3]]
+        acc = AccessControl(model=self.model)
+        logmsg = dict(action='create_many', account_id=acc.account_id,
+                      resource=self.resource, ident=acc.identity)
+        if self.resource == 'apikey' or (
+                hasattr(self.model, '__rest_related__') and any(
+                    related in item for item in body
+                    for related in self.model.__rest_related__)):
+            return dict(message=_(u'bulk create not supported')), 405
+        categories, ranks = {}, None
+        if self.resource == 'contact':
+            try:
+                ranks = dict(((uid, type), count) for uid, type, count in
+                             g.db.query(self.model.uid, self.model.type,
+                                        func.count()).filter(
+                    self.model.uid.in_(set(item.get('uid', acc.uid)
+                                           for item in body))).group_by(
+                    self.model.uid, self.model.type).all())
+            except Exception as ex:
+                return db_abort(str(ex), **logmsg)
+        results, records, allowed = [], [], {}
+        for item in body:
+            if 'id' in item:
+                results.append(dict(message='id is a read-only property',
+                                    status=405))
+                continue
+            if self.resource == 'contact':
+                retval = self._create_contact(item, bulk=True)
+                if retval[1] != 201:
+                    results.append(dict(status=retval[1], **retval[0]))
+                    continue
+            if item.get('expires'):
+                try:
+                    item['expires'] = self._fromdate(item['expires'])
+                except Exception:
+                    results.append(dict(message=_(u'invalid date'),
+                                        status=405))
+                    continue
+            if hasattr(self.model, 'uid') and not item.get('uid'):
+                item['uid'] = acc.uid
+            key = (item.get('uid'), item.get('event_id'))
+            if key not in allowed:
+                allowed[key] = acc.with_permission(
+                    'c', new_uid=key[0], membership=acc.primary_resource,
+                    id=key[1])
+            if not allowed[key]:
+                results.append(dict(message=_(u'access denied'), status=403))
+                continue
+            if not item.get('category_id') and hasattr(
+                    self.model, 'category_id'):
+                item['category_id'] = self._default_category(
+                    acc, event_id=key[1], cache=categories)
+                if not item['category_id']:
+                    results.append(dict(message=_(u'access denied'),
+                                        status=403))
+                    continue
+            if hasattr(self.model, 'status'):
+                item['status'] = item.get('status', 'active')
+            item['id'] = utils.gen_id(prefix=id_prefix)
+            item['created'] = utils.utcnow()
+            try:
+                self.model(**item)
+            except (AttributeError, TypeError) as ex:
+                results.append(dict(message=str(ex), status=405))
+                continue
+            if ranks is not None and not item.get('rank'):
+                # Ranks are only assigned once an item is accepted
+                rank = (item['uid'], item.get('type'))
+                item['rank'] = ranks[rank] = ranks.get(rank, 0) + 1
+            results.append(dict(id=item['id'], status=201))
+            records.append(item)
+
+        grant = (self.resource if self.resource.endswith('s')
+                 else self.resource + 's')
+        if records and grant in ServiceConfig().config.DEFAULT_GRANTS:
+            batch = {}
+            for item in records:
+                batch[item.get('uid')] = batch.get(item.get('uid'), 0) + 1
+            existing = dict(g.db.query(self.model.uid, func.count()).filter(
+                self.model.uid.in_(batch.keys())).group_by(
+                self.model.uid).all())
+            for uid, count in batch.items():
+                limit = Grants().get(grant, uid=uid)
+                if existing.get(uid, 0) + count > limit:
+                    msg = _('user limit exceeded')
+                    logging.info(dict(message=msg, allowed=limit, uid=uid,
+                                      requested=count, **logmsg))
+                    return dict(message=msg, allowed=limit), 405
+        if records:
+            try:
+                g.db.bulk_insert_mappings(self.model, records)
+                g.db.commit()
+            except IntegrityError as ex:
+                g.db.rollback()
+                message = 'duplicate or other conflict'
+                logging.warning(dict(message=message, error=str(ex),
+                                     **logmsg))
+                return dict(message='%s, no items were created' % message,
+                            count=0), 405
+            except Exception as ex:
+                return db_abort(str(ex), rollback=True, **logmsg)
+        logging.info(dict(count=len(records), requested=len(body),
+                          duration=utils.req_duration(), **logmsg))
+        return dict(items=results, count=len(records)), (
+            201 if records else 405)
+
     @staticmethod
     def get(id):
         """Controller for GET endpoints. This method evaluates
@@ -289,33 +433,21 @@ class BasicCRUD(object):
         logmsg = dict(action='delete', resource=self.resource,
                       account_id=AccessControl().account_id,
                       ident=AccessControl().identity)
-        errors = 0
-        count = 0
-        for id in ids:
-            try:
-                query = g.db.query(self.model).filter_by(id=id)
-                if not AccessControl(
-                        model=self.model).with_permission(
-                            'd', query=query):
-                    return dict(message=_(u'access denied'), id=id), 403
-                if force:
-                    if query.delete():
-                        logging.info(dict(id=id, **logmsg))
-                    else:
-                        logging.info(dict(id=id, msg='query failed', **logmsg))
-                        errors += 1
-                else:
-                    logging.info(dict(id=id, status='disabled', **logmsg))
-                    query.update(dict(status='disabled'))
-            except Exception as ex:
-                return db_abort(str(ex), **logmsg)
-            count += 1
+        try:
+            denied, missing = self._delete_set(self.model, ids, force=force)
+        except Exception as ex:
+            return db_abort(str(ex), **logmsg)
+        if denied:
+            return dict(message=_(u'access denied'), id=denied), 403
         try:
             g.db.commit()
         except Exception as ex:
             return db_abort(str(ex), rollback=True, **logmsg)
-        logging.info(dict(count=count, ids=ids, **logmsg))
-        return NoContent, 404 if errors else 204
+        if missing and force:
+            logging.info(dict(msg='query failed', missing=missing, **logmsg))
+        logging.info(dict(count=len(ids), ids=ids, **logmsg, **(
+            {} if force else dict(status='disabled'))))
+        return NoContent, 404 if missing and force else 204
 
     @staticmethod
     def find(**kwargs):
@@ -346,8 +478,22 @@ class BasicCRUD(object):
             return dict(message=_(u'access denied')), 403
         conditions = {item: value for item, value in kwargs.items()
                       if item in ('status')}
+        seek = None
         if 'cursor_next' in kwargs:
-            offset = int(self._fromb64(kwargs['cursor_next']).split(':')[1])
+            try:
+                cursor = self._fromb64(kwargs['cursor_next'])
+                if cursor.startswith('keyset:'):
+                    offset = 0
+                    seek = json.loads(cursor.split(':', 1)[1])
+                    if type(seek) is not list or len(seek) != 2 or any(
+                            type(item) in (dict, list) for item in seek):
+                        raise ValueError('keyset %s' % seek)
+                else:
+                    offset = int(cursor.split(':')[1])
+            except (IndexError, ValueError) as ex:
+                logging.info(dict(message='invalid cursor', error=str(ex),
+                                  **logmsg))
+                return dict(message=_(u'invalid cursor')), 400
         elif 'offset' in kwargs:
             offset = int(kwargs['offset'])
         else:
@@ -359,6 +505,7 @@ class BasicCRUD(object):
             sortdir = desc if dir == 'desc' else asc
         else:
             sortdir = asc
+        keyset = self._keyset_column(sort)
         query = g.db.query(self.model)
         limit = int(kwargs.get('limit', Constants.PER_PAGE_DEFAULT))
         try:
@@ -412,6 +559,8 @@ class BasicCRUD(object):
         try:
             query = query.filter_by(**filter).order_by(
                 sortdir(getattr(self.model, sort)))
+            if keyset is not None and sort != 'id':
+                query = query.order_by(sortdir(self.model.id))
         except InvalidRequestError as ex:
             logging.warning(dict(message=str(ex), **logmsg))
             return dict(message=_(u'invalid filter specified')), 405
@@ -420,34 +569,66 @@ class BasicCRUD(object):
         else:
             query = query.filter(self.model.status != 'disabled')
         query = acc.with_filter(query)
+        page = query.options(*self._eager_options())
+        if seek:
+            try:
+                if keyset is None:
+                    raise ValueError('no keyset for sort=%s' % sort)
+                value = (self._fromdate(seek[0]) if
+                         isinstance(keyset.type, DateTime) else seek[0])
+            except (TypeError, ValueError) as ex:
+                logging.info(dict(message='invalid cursor', error=str(ex),
+                                  **logmsg))
+                return dict(message=_(u'invalid cursor')), 400
+            if sort == 'id':
+                key, value = (self.model.id, value)
+            else:
+                key, value = (tuple_(keyset, self.model.id),
+                              tuple_(value, seek[1]))
+            page = page.filter(key > value if sortdir is asc else key < value)
+        strategy = ServiceConfig().config.PAGINATION_COUNT
         try:
-            results = query.slice(offset, offset + limit + 1).all()
-            retval = dict(items=[], count=query.count())
+            if strategy == 'window' and not seek:
+                rows = page.add_columns(func.count().over()).slice(
+                    offset, offset + limit + 1).all()
+                results = [row[0] for row in rows]
+                total = rows[0][1] if rows else self._count(query)
+            else:
+                results = page.slice(offset, offset + limit + 1).all()
+                total = self._count(query, key=(
+                    acc.uid, kwargs.get('filter'), kwargs.get('status'))
+                    if strategy == 'estimate' else None)
+            retval = dict(items=[], count=total)
         except Exception as ex:
             return db_abort(str(ex), **logmsg)
         count = 0
-        # logging.info(dict(step=1, membership=acc.primary_resource, **logmsg))
-        for result in results[:limit]:
-            record = result.as_dict()
+        records = [result.as_dict() for result in results[:limit]]
+        # Eager-loaded relationships show up in as_dict() as objects
+        loaded = [key for key in inspect(self.model).relationships.keys()
+                  if key not in getattr(self.model, '__rest_related__', ())]
+        for result, record, rbac in zip(
+                results, records, acc.rbac_permissions_bulk(records)):
+            for key in loaded:
+                record.pop(key, None)
             if hasattr(self.model, 'owner'):
                 record['owner'] = result.owner.name
-            # TODO - find a way to avoid this, causes KeyError on lazy-load
             if record.get('category_id'):
                 record['category'] = result.category.name
-            # TODO - takes 30ms per record for rbac: optimize or redesign
-            # logging.info(dict(step=2, id=record.get('id'),
-            #     privacy=record.get('privacy')))
-            record['rbac'] = ''.join(sorted(list(
-                acc.rbac_permissions(owner_uid=record.get('uid'),
-                                     membership=acc.primary_resource,
-                                     id=record.get('id'),
-                                     privacy=record.get('privacy'))
-                - set('c'))))
+            record['rbac'] = rbac
             retval['items'].append(record)
             count += 1
         if len(results) > limit:
-            retval['cursor_next'] = self._tob64('cursor:%d' % (offset + limit))
-        elif count < retval['count'] and count < limit and offset == 0:
+            if (keyset is not None and
+                    ServiceConfig().config.PAGINATION == 'keyset'):
+                last = results[limit - 1]
+                retval['cursor_next'] = self._tob64('keyset:%s' % json.dumps(
+                    [getattr(last, sort), last.id], separators=(',', ':'),
+                    default=lambda val: val.strftime('%Y-%m-%dT%H:%M:%S.%fZ')))
+            else:
+                retval['cursor_next'] = self._tob64(
+                    'cursor:%d' % (offset + limit))
+        elif (count < retval['count'] and count < limit and offset == 0
+              and not seek):
             # TODO find a way to get query.count() to return accurate value
             retval['count'] = count
         logging.info(dict(
@@ -455,12 +636,132 @@ class BasicCRUD(object):
             duration=utils.req_duration(), **conditions, **logmsg))
         return retval, 200
 
-    def _create_contact(self, body):
+    def _count(self, query, key=None):
+        """Count the rows matched by a find query
+
+        Args:
+          query (obj): SQLAlchemy query, without pagination
+          key (tuple): if specified, cache the result under a hash of
+            this key for PAGINATION_COUNT_TTL seconds
+        Returns:
+          int: number of rows
+        """
+        if key is None:
+            return query.count()
+        key = hashlib.sha1(json.dumps(
+            (self.resource,) + key).encode()).hexdigest()
+        with self._lock:
+            if BasicCRUD._counts is None:
+                config = ServiceConfig().config
+                BasicCRUD._counts = TTLCache(
+                    maxsize=config.CACHE_SIZE,
+                    ttl=config.PAGINATION_COUNT_TTL)
+            count = self._counts.get(key)
+        if count is None:
+            count = query.count()
+            with self._lock:
+                self._counts[key] = count
+        return count
+
+    def _keyset_column(self, sort):
+        """Look up the column for keyset pagination
+
+        Args:
+          sort (str): name of the sort attribute
+        Returns:
+          obj: the column if it is a plain non-nullable column of the
+            model, otherwise None (offset pagination is used)
+        """
+        try:
+            column = inspect(self.model).columns[sort]
+        except KeyError:
+            return None
+        return None if column.nullable else column
+
+    def _eager_options(self):
+        """Build loader options for the relationships that find()
+        reads from each result (owner, category and __rest_related__
+        lists), so that a page is fetched with a fixed number of queries
+
+        Returns:
+          list: joinedload for scalar relationships, selectinload
+            for collections; empty if eager_load is disabled
+        """
+        if not getattr(self, 'eager_load', True):
+            return []
+        model = self.model
+        relationships = inspect(model).relationships
+        keys = ('owner', 'category') + getattr(
+            model, '__rest_related__', ())
+        return [(selectinload if relationships[key].uselist else joinedload)(
+            getattr(model, key)) for key in keys if key in relationships and
+            relationships[key].lazy != 'dynamic']
+
+    def _delete_set(self, model, ids, force=False):
+        """Remove or disable a set of records of one model, with one
+        query to load them, a bulk permission check and one UPDATE or
+        DELETE statement
+
+        Args:
+          model (obj): model of the records
+          ids (list of str): record IDs
+          force (bool): remove rows if true, otherwise disable them
+        Returns:
+          tuple: ID of first record for which delete permission is denied
+            (None if all are allowed), and number of IDs not found
+        """
+        # Permissions only need columns: skip loading any relationship
+        records = {record.id: record.as_dict() for record in g.db.query(
+            model).options(noload('*')).filter(model.id.in_(ids))}
+        rbacs = AccessControl(model=model).rbac_permissions_bulk(
+            [records.get(id, {}) for id in ids], by_id=False)
+        for id, rbac in zip(ids, rbacs):
+            if 'd' not in rbac:
+                return id, 0
+        if records:
+            query = g.db.query(model).filter(model.id.in_(records.keys()))
+            if force:
+                query.delete(synchronize_session=False)
+            else:
+                query.update(dict(status='disabled'),
+                             synchronize_session=False)
+        return None, len(set(ids) - set(records))
+
+    def _default_category(self, acc, event_id=None, cache=None):
+        """Look up the category of a new record which doesn't specify
+        one: the account's default, or else that of its event
+
+        Args:
+          acc (obj): AccessControl instance for the request
+          event_id (str): ID of the record's event, if any
+          cache (dict): results keyed by event_id (for bulk create)
+        Returns:
+          str: category ID, or None if there is neither
+        """
+        key = None if acc.account_id else event_id
+        if cache is not None and key in cache:
+            return cache[key]
+        category_id = None
+        if acc.account_id:
+            category_id = AccountSettings(
+                acc.account_id, g.db).get.category_id
+        elif event_id:
+            try:
+                category_id = g.db.query(self.models.Event).filter_by(
+                    id=event_id).one().category_id
+            except NoResultFound:
+                pass
+        if cache is not None:
+            cache[key] = category_id
+        return category_id
+
+    def _create_contact(self, body, bulk=False):
         """Perform pre-checks against fields for contact resource
         prior to rest of contact-create
 
         Args:
             body (dict): as defined in openapi.yaml schema
+            bulk (bool): the caller assigns rank (for bulk create)
         """
         logmsg = dict(action='create', resource='contact',
                       uid=body.get('uid'))
@@ -477,7 +778,7 @@ class BasicCRUD(object):
                 return dict(message=_(u'invalid email address')), 405
         elif 'type' in body and body.get('type') not in ['sms', 'email']:
             return dict(message='contact type not yet supported'), 405
-        if not body.get('rank'):
+        if not body.get('rank') and not bulk:
             try:
                 count = g.db.query(self.models.Contact).filter_by(
                     uid=body.get('uid'), type=body.get('type')).count()
@@ -566,22 +867,43 @@ class BasicCRUD(object):
                 action='update', resource=self.resource, allowed=limit,
                 field=attr, uid=AccessControl().uid, message=msg))
             return dict(message=msg, allowed=limit), 405
-        if attr == 'members':
-            model = getattr(self.models, 'Person')
-        else:
-            model = getattr(self.models, attr.capitalize().strip('s'))
-        query = g.db.query(self.model).filter_by(id=id).one()
-        current = [item.id for item in getattr(query, attr)]
-        for missing_member in set(related_ids) - set(current):
-            getattr(query, attr).append(g.db.query(model).filter_by(
-                id=missing_member).one())
-        g.db.flush()
-        for removed_member in set(current) - set(related_ids):
-            getattr(query, attr).remove(g.db.query(model).filter_by(
-                id=removed_member).one())
+        relationship = inspect(self.model).relationships[attr]
+        table = relationship.secondary
+        (parent_id, local), = relationship.synchronize_pairs
+        (related_id, remote), = relationship.secondary_synchronize_pairs
+        current = set(row[0] for row in g.db.execute(
+            select([remote]).where(local == id)))
+        added = set(related_ids) - current
+        removed = current - set(related_ids)
+        if added:
+            missing = self._missing_related(attr, added)
+            if missing:
+                return dict(message=_(u'not found'), ids=missing), 404
+            g.db.execute(table.insert(), [
+                {local.name: id, remote.name: item} for item in added])
+        if removed:
+            g.db.execute(table.delete().where(and_(
+                local == id, remote.in_(removed))))
         g.db.commit()
         return dict(id=id, status='ok', items=len(related_ids)), 200
 
+    def _missing_related(self, attr, related_ids):
+        """Look up IDs for a many-to-many relationship in one query
+
+        Args:
+          attr (str): relationship attribute name
+          related_ids (list): IDs of records in related table
+        Returns:
+          list: sorted IDs which don't exist
+        """
+        if not related_ids:
+            return []
+        relationship = inspect(self.model).relationships[attr]
+        (related_id, remote), = relationship.secondary_synchronize_pairs
+        found = set(row[0] for row in g.db.query(related_id).filter(
+            related_id.in_(set(related_ids))))
+        return sorted(set(related_ids) - found)
+
     @staticmethod
     def _tob64(text):
         return base64.b64encode(bytes(text, 'utf8')).decode('ascii')
@@ -16,12 +16,15 @@ class Constants:
     DEFAULT_COUNTRY = u'US'
     DEFAULT_LANG = u'en_US'
     DEFAULT_WINDOW_TITLE = u'Example apicrud Application'
+    HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                         5.0, 10.0)
     LIB_MOD_SPATIALITE = ['/usr/lib/x86_64-linux-gnu/mod_spatialite.so',
                           '/usr/lib/mod_spatialite.so.7']
     MFA_BACKUP_CODELEN = 8
     MIME_IMAGE_TYPES = ("gif", "heic", "jpeg", "png", "svg")
     MIME_VIDEO_TYPES = ("mp4", "mpeg")
     PER_PAGE_DEFAULT = 100
+    REDIS_CHECK_INTERVAL = 1
     REDIS_TTL = 3600
     REGEX_EMAIL = r'[a-z0-9._%+-]+@[a-z0-9.-]+\.[a-z]{2,}'
     REGEX_PHONE = r'[0-9()+ -]{5,20}'
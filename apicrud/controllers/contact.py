@@ -24,6 +24,24 @@ class ContactController(BasicCRUD):
             retval[0].update(result[0])
         return retval
 
+    @staticmethod
+    def create_many(body):
+        """after creating records, send confirmation messages
+
+        Args:
+          body (list): as defined in openapi.yaml schema
+        """
+        retval = super(ContactController, ContactController).create_many(
+            body)
+        created = [item for item in retval[0].get('items', [])
+                   if item['status'] == 201]
+        if created:
+            results = Confirmation().request_many(
+                [item['id'] for item in created])
+            for item in created:
+                item.update(results.get(item['id'], {}))
+        return retval
+
     @staticmethod
     def update(id, body):
         """contact update - uses special-case function
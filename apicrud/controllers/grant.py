@@ -3,7 +3,9 @@
 created 27-may-2019 by richb@instantlinux.net
 """
 
-from apicrud import BasicCRUD, Grants
+from flask import g
+
+from apicrud import BasicCRUD, Grants, state
 
 
 class GrantController(BasicCRUD):
@@ -27,14 +29,46 @@ class GrantController(BasicCRUD):
             id (str): Database or hybrid grant ID
             body (dict): resource fields as defined by openapi.yaml schema
         """
-        Grants().uncache(body.get('uid'))
         if not body.get('expires'):
             body['expires'] = None
         if ':' in id:
             body['uid'] = id.split(':')[0]
             body.pop('id', None)
-            return super(GrantController, GrantController).create(body)
-        return super(GrantController, GrantController).update(id, body)
+            ret = super(GrantController, GrantController).create(body)
+            Grants().uncache(body['uid'])
+            return ret
+        uids = GrantController._owners([id]) | set([body.get('uid')])
+        ret = super(GrantController, GrantController).update(id, body)
+        for uid in uids:
+            Grants().uncache(uid)
+        return ret
+
+    @staticmethod
+    def delete(ids, force=False):
+        """Delete grants, and invalidate cached grants of their owners
+
+        Args:
+            ids (list of str): record IDs to be flagged for removal
+            force (bool): flag for removal if false; remove data if true
+        """
+        uids = GrantController._owners(ids)
+        ret = super(GrantController, GrantController).delete(ids, force=force)
+        for uid in uids:
+            Grants().uncache(uid)
+        return ret
+
+    @staticmethod
+    def _owners(ids):
+        """Look up the uids which own a set of grants
+
+        Args:
+            ids (list of str): grant record IDs
+        Returns:
+            set: uids
+        """
+        model = state.models.Grant
+        return set(rec.uid for rec in g.db.query(model.uid).filter(
+            model.id.in_(ids)))
 
     @staticmethod
     def get(id):
@@ -3,9 +3,47 @@
 created 27-may-2019 by richb@instantlinux.net
 """
 
-from apicrud import BasicCRUD
+from flask import g
+
+from apicrud import BasicCRUD, ProfileCache, state
 
 
 class ProfileController(BasicCRUD):
     def __init__(self):
         super().__init__(resource='profile')
+
+    @staticmethod
+    def create(body):
+        ret = super(ProfileController, ProfileController).create(body)
+        ProfileCache.uncache(body.get('uid'))
+        return ret
+
+    @staticmethod
+    def update(id, body):
+        uids = ProfileController._owners([id])
+        ret = super(ProfileController, ProfileController).update(id, body)
+        for uid in uids | set([body.get('uid')]):
+            ProfileCache.uncache(uid)
+        return ret
+
+    @staticmethod
+    def delete(ids, force=False):
+        uids = ProfileController._owners(ids)
+        ret = super(ProfileController, ProfileController).delete(
+            ids, force=force)
+        for uid in uids:
+            ProfileCache.uncache(uid)
+        return ret
+
+    @staticmethod
+    def _owners(ids):
+        """Look up the uids which own a set of profile items
+
+        Args:
+            ids (list of str): profile item IDs
+        Returns:
+            set: uids
+        """
+        model = state.models.Profile
+        return set(rec.uid for rec in g.db.query(model.uid).filter(
+            model.id.in_(ids)))
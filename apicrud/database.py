@@ -15,6 +15,7 @@ import logging
 import os.path
 from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.event import listen
 from sqlalchemy.exc import NoReferencedTableError, OperationalError, \
@@ -22,6 +23,7 @@ from sqlalchemy.exc import NoReferencedTableError, OperationalError, \
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import select, func
 import sys
+import threading
 import time
 import yaml
 
@@ -31,16 +33,35 @@ from .service_config import ServiceConfig
 from .utils import utcnow
 
 Base = declarative_base()
+checkout_requested = threading.local()
 db_engine = None
-Session = None
+sessions = {}
 spatialite_loaded = False
 
 
+class TimedQueuePool(QueuePool):
+    """Connection pool which notes when each checkout is requested, so
+    that the checkout listener can record the time spent waiting as a
+    histogram metric"""
+
+    def connect(self):
+        checkout_requested.start = time.monotonic()
+        return super().connect()
+
+    def unique_connection(self):
+        checkout_requested.start = time.monotonic()
+        return super().unique_connection()
+
+
 def get_session(scopefunc=None, scoped=True, db_url=None, engine=None):
     """open a db session scoped to flask context or celery thread
 
+    The session factory and scoped registry are built once per engine
+    and scope function, so repeated calls return the same registry
+
     Args:
       scopefunc (function): function which returns a unique thread ID
+        [default: greenlet.getcurrent]
       scoped (bool): whether to use scoped session management
       db_url (str): URL of database
       engine (obj): override engine object (for unit tests)
@@ -52,20 +73,32 @@ def get_session(scopefunc=None, scoped=True, db_url=None, engine=None):
     if not engine:
         # This is where init_db is invoked under celery
         engine = db_engine or _init_db(db_url=db_url)
-    if scoped:
-        global Session
-        if scopefunc is None:
-            scopefunc = greenlet.getcurrent
-        Session = scoped_session(sessionmaker(autocommit=False,
-                                              autoflush=False,
-                                              bind=engine),
-                                 scopefunc=scopefunc)
-        if engine.url.drivername == 'sqlite':
-            Session.execute('PRAGMA foreign_keys=on')
-        return Session
-    else:
-        Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-        return Session
+    scopefunc = (scopefunc or greenlet.getcurrent) if scoped else None
+    key = (engine, scopefunc)
+    if key not in sessions:
+        session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        if scoped:
+            session = scoped_session(session, scopefunc=scopefunc)
+        sessions[key] = session
+    session = sessions[key]
+    if scoped and engine.url.drivername == 'sqlite':
+        session.execute('PRAGMA foreign_keys=on')
+    return session
+
+
+def pool_stats(engine=None):
+    """Connection counts of the database engine's pool
+
+    Args:
+      engine (obj): engine [default: db_engine]
+    Returns:
+      dict: checked_out, overflow and size (empty if not a QueuePool)
+    """
+    pool = getattr(engine or db_engine, 'pool', None)
+    if not isinstance(pool, QueuePool):
+        return {}
+    return dict(checked_out=pool.checkedout(),
+                overflow=max(pool.overflow(), 0), size=pool.size())
 
 
 def initialize_db(db_url=None, engine=None, redis_conn=None):
@@ -257,16 +290,24 @@ def _init_db(db_url=None, engine=None, connection_timeout=0,
              geo_support=True):
     global db_engine
     if not db_engine:
+        config = ServiceConfig().config
         if 'postgres' not in db_url:
             execution_options = dict(schema_translate_map={
-                key: None for key in ServiceConfig().config.DB_SCHEMAS})
+                key: None for key in config.DB_SCHEMAS})
+        pool_options = {} if db_url.startswith('sqlite') else dict(
+            max_overflow=config.DB_POOL_MAX_OVERFLOW,
+            pool_size=config.DB_POOL_SIZE,
+            pool_timeout=config.DB_POOL_TIMEOUT, poolclass=TimedQueuePool)
         try:
             db_engine = engine or create_engine(
                 db_url, execution_options=execution_options,
-                pool_pre_ping=True, pool_recycle=connection_timeout)
+                pool_pre_ping=config.DB_POOL_PRE_PING,
+                pool_recycle=connection_timeout, **pool_options)
         except Exception as ex:
             logging.error('action=init_db status=error message=%s' % str(ex))
             return None
+        listen(db_engine, 'connect', _record_connect)
+        listen(db_engine, 'checkout', _record_checkout)
     if db_engine.url.drivername == 'sqlite':
         db_engine.execute('PRAGMA foreign_keys=on')
         if geo_support:
@@ -287,6 +328,23 @@ def _init_db(db_url=None, engine=None, connection_timeout=0,
     return db_engine
 
 
+def _record_connect(dbapi_conn, connection_record):
+    connection_record.info['created'] = time.time()
+
+
+def _record_checkout(dbapi_conn, connection_record, connection_proxy):
+    from .metrics import Metrics
+
+    if 'created' in connection_record.info:
+        Metrics().store('db_pool_connection_age_seconds',
+                        value=time.time() - connection_record.info['created'])
+    start = getattr(checkout_requested, 'start', None)
+    if start is not None:
+        checkout_requested.start = None
+        Metrics().store('db_pool_wait_seconds',
+                        value=time.monotonic() - start)
+
+
 def _load_spatialite(dbapi_conn, connection_record):
     global spatialite_loaded
     for lib in Constants.LIB_MOD_SPATIALITE:
@@ -9,9 +9,12 @@ from flask_babel import _
 from inflection import singularize
 import json
 import logging
+import redis
 from sqlalchemy.orm.exc import NoResultFound
+import threading
 
 from .access import AccessControl
+from .redis_pool import redis_connect, subscribe
 from .service_config import ServiceConfig
 from . import utils, state
 
@@ -25,14 +28,24 @@ class Grants(object):
     If a record matches a user uid, the default grant name=value is
     overridden.
 
+    Grants are cached in two tiers: a local in-process LRU in front
+    of a redis hash per uid. Each uid has a version stamp which is
+    bumped whenever one of its grants is changed; the change is
+    published to all workers, which evict their local copy.
+
     Attributes:
       db_session (obj): existing db session
       ttl (int): how long to cache a grant in memory
+      redis_conn (obj): connection to redis service
     """
     _singleton = None
     _cache = None
+    _defaults = None
+    _lock = threading.Lock()
+    _thread = None
+    channel = 'gra:invalidate'
 
-    def __init__(self, db_session=None, ttl=None):
+    def __init__(self, db_session=None, ttl=None, redis_conn=None):
         self.models = ServiceConfig().models
         self.session = db_session
         if not self.session:
@@ -41,16 +54,19 @@ class Grants(object):
             except RuntimeError as ex:
                 if 'Working outside of application context' not in str(ex):
                     raise
-        config = ServiceConfig().config
-        if 'defaults' not in self._cache:
-            self._cache['defaults'] = config.DEFAULT_GRANTS
+        self.config = config = ServiceConfig().config
+        self.connection = redis_conn or state.redis_conn or redis_connect()
+        if Grants._defaults is None:
+            Grants._defaults = config.DEFAULT_GRANTS
+        if not (Grants._thread and Grants._thread.is_alive()):
+            self._subscribe()
 
-    def __new__(cls, db_session=None, ttl=None):
+    def __new__(cls, db_session=None, ttl=None, redis_conn=None):
         if cls._singleton is None:
             cls._singleton = super(Grants, cls).__new__(cls)
             config = ServiceConfig().config
             cls._cache = TTLCache(maxsize=config.CACHE_SIZE,
-                                  ttl=ttl or config.REDIS_TTL)
+                                  ttl=ttl or config.GRANTS_CACHE_TTL)
         return cls._singleton
 
     def get(self, name, uid=None):
@@ -64,21 +80,19 @@ class Grants(object):
         """
         if not uid:
             uid = AccessControl().uid
-        if uid not in self._cache:
-            records = self.session.query(self.models.Grant).filter_by(
-                uid=uid, status='active').all()
-            grants = {}
-            for rec in records:
-                if not rec.expires or rec.expires > utils.utcnow():
-                    grants[rec.name] = rec.value
-            self._cache[uid] = grants
-        if name in self._cache[uid]:
-            ret = self._cache[uid].get(name)
+        with self._lock:
+            grants = self._cache.get(uid)
+        if grants is None:
+            grants = self._load(uid)
+            with self._lock:
+                self._cache[uid] = grants
+        if name in grants:
+            ret = grants.get(name)
         else:
-            if (name not in self._cache['defaults'] and singularize(name)
+            if (name not in self._defaults and singularize(name)
                     not in state.controllers.keys()):
                 logging.error('Grant name=%s undefined in config.yaml' % name)
-            ret = self._cache['defaults'].get(name)
+            ret = self._defaults.get(name)
         try:
             return int(ret, 0)
         except (TypeError, ValueError):
@@ -132,7 +146,7 @@ class Grants(object):
             uid = filter.get('uid') or acc.uid
         rbac = ''.join(sorted(list(acc.rbac_permissions(owner_uid=uid))))
         result = []
-        for key, val in self._cache['defaults'].items():
+        for key, val in self._defaults.items():
             if name and key != name:
                 continue
             for row in crud_results[0]['items']:
@@ -147,12 +161,27 @@ class Grants(object):
         return dict(items=result, count=len(result)), crud_results[1]
 
     def uncache(self, uid):
-        """Remove grants from cache, any time a user's status changes
+        """Remove grants from cache, any time a user's status changes:
+        bumps the uid's version stamp, drops the shared redis copy and
+        notifies all workers to evict their local copy
 
         Args:
           uid (str): user ID
         """
-        self._cache.pop(uid, None)
+        if not uid:
+            return
+        with self._lock:
+            self._cache.pop(uid, None)
+        try:
+            pipe = self.connection.pipeline()
+            pipe.incr('grv:%s' % uid)
+            pipe.expire('grv:%s' % uid, 2 * self.config.REDIS_TTL)
+            pipe.delete('gra:%s' % uid)
+            version = pipe.execute()[0]
+            self.connection.publish(self.channel, '%s:%d' % (uid, version))
+        except redis.exceptions.ConnectionError as ex:
+            logging.error(dict(action='grants.uncache', uid=uid,
+                               message=str(ex)))
 
     def load_defaults(self, defaults):
         """Load default values from a dict of keyword: value pairs
@@ -160,4 +189,92 @@ class Grants(object):
         Args:
           defaults (dict): new defaults
         """
-        self._cache['defaults'] = defaults
+        Grants._defaults = defaults
+
+    def _load(self, uid):
+        """Fetch a uid's grants from redis if the stored copy matches
+        the current version stamp, otherwise from the database; a copy
+        read from the database is stored in redis under the version
+        which was current before the query, so that an update made
+        in the meantime causes it to be discarded
+
+        Args:
+          uid (str): user ID
+        Returns:
+          dict: grant name=value pairs
+        """
+        try:
+            pipe = self.connection.pipeline(transaction=False)
+            pipe.get('grv:%s' % uid)
+            pipe.hgetall('gra:%s' % uid)
+            version, stored = pipe.execute()
+        except redis.exceptions.ConnectionError as ex:
+            logging.warning(dict(action='grants.get', uid=uid,
+                                 message=str(ex)))
+            return self._query(uid)[0]
+        version = int(version or 0)
+        grants = {_str(key): _str(val) for key, val in stored.items()}
+        if grants.pop('_v', None) == str(version):
+            return grants
+        grants, ttl = self._query(uid)
+        try:
+            pipe = self.connection.pipeline(transaction=False)
+            pipe.delete('gra:%s' % uid)
+            pipe.hset('gra:%s' % uid, mapping=dict(grants, _v=version))
+            pipe.expire('gra:%s' % uid, ttl)
+            pipe.execute()
+        except redis.exceptions.ConnectionError as ex:
+            logging.warning(dict(action='grants.get', uid=uid,
+                                 message=str(ex)))
+        return grants
+
+    def _query(self, uid):
+        """Query the database for a uid's active grants
+
+        Args:
+          uid (str): user ID
+        Returns:
+          tuple: dict of grant name=value pairs, and the number
+            of seconds until the first of them expires
+        """
+        records = self.session.query(self.models.Grant).filter_by(
+            uid=uid, status='active').all()
+        grants = {}
+        ttl = self.config.REDIS_TTL
+        now = utils.utcnow()
+        for rec in records:
+            if not rec.expires:
+                grants[rec.name] = rec.value
+            elif rec.expires > now:
+                grants[rec.name] = rec.value
+                ttl = max(1, min(ttl, int(
+                    (rec.expires - now).total_seconds())))
+        return grants, ttl
+
+    def _subscribe(self):
+        """Start a thread which evicts local entries for uids
+        published by other workers; this is retried on a later call
+        if redis is unreachable, or in a forked child. The local
+        cache is dropped whenever notifications may have been missed.
+        """
+        def _evict(message):
+            uid = _str(message['data']).rsplit(':', 1)[0]
+            with Grants._lock:
+                Grants._cache.pop(uid, None)
+
+        def _reset():
+            with Grants._lock:
+                Grants._cache.clear()
+
+        with Grants._lock:
+            if Grants._thread and Grants._thread.is_alive():
+                return
+            Grants._thread = subscribe(self.connection, self.channel,
+                                       _evict, reset=_reset)
+            if Grants._thread:
+                Grants._cache.clear()
+
+
+def _str(value):
+    """Decode a redis response value"""
+    return value.decode() if isinstance(value, bytes) else value
@@ -9,15 +9,20 @@ from flask_cors import CORS
 import logging
 import os
 import redis
+import time
+from werkzeug.middleware.proxy_fix import ProxyFix
 
-from . import database, AccessControl, AccountSettings, Metrics, RateLimit, \
-    ServiceConfig, ServiceRegistry, state
+from . import database, AccessControl, AccountSettings, ClientLimit, \
+    Metrics, RateLimit, ServiceConfig, ServiceRegistry, state
 from .auth.ldap_func import ldap_init
 from .auth.oauth2_func import oauth2_init
 from .const import Constants
+from .redis_pool import redis_connect
 from .session_manager import SessionManager
 from .utils import utcnow
 
+redis_verified = 0
+
 
 def app(application, controllers, models, path, redis_conn=None,
         func_send=None, **kwargs):
@@ -47,6 +52,10 @@ def app(application, controllers, models, path, redis_conn=None,
                         datefmt='%m-%d %H:%M:%S')
     logging.getLogger('werkzeug').setLevel(logging.ERROR)
     application.app.config.from_object(config)
+    if config.TRUSTED_PROXY_HOPS:
+        application.app.wsgi_app = ProxyFix(
+            application.app.wsgi_app, x_for=config.TRUSTED_PROXY_HOPS,
+            x_proto=config.TRUSTED_PROXY_HOPS)
     application.add_api(
         os.path.join(os.path.dirname(os.path.abspath(__file__)),
                      Constants.SERVICE_CONFIG_FILE), base_path='/config/v1')
@@ -61,10 +70,10 @@ def app(application, controllers, models, path, redis_conn=None,
     state.config = config
     state.func_send = func_send
     state.models = models
-    state.redis_conn = redis_conn or redis.Redis(
-        host=config.REDIS_HOST, port=config.REDIS_PORT, db=0)
+    state.redis_conn = redis_conn or redis_connect()
     ServiceRegistry().register(controllers.resources())
     if database.initialize_db(db_url=config.DB_URL, redis_conn=redis_conn):
+        Metrics().backfill_index()
         Metrics().store(
             'api_start_timestamp', value=int(datetime.now().timestamp()))
     AccessControl().load_rbac(config.RBAC_FILE)
@@ -98,47 +107,62 @@ def worker(models, path, func_send=None, redis_conn=None):
     state.config = config
     state.func_send = func_send
     state.models = models
-    state.redis_conn = redis_conn or redis.Redis(
-        host=config.REDIS_HOST, port=config.REDIS_PORT, db=0)
-    # Register send_contact, for usage-alert notifications
-    Metrics(func_send=func_send)
+    state.redis_conn = redis_conn or redis_connect()
+    # Register send_contact, for usage-alert notifications; the sampler
+    #  thread also flushes histogram observations
+    Metrics(func_send=func_send).start_sampler()
     logging.info(dict(action='initialize_app', port=config.APP_PORT,
                       duration='%.3f' % (utcnow().timestamp() - start)))
 
 
 def before_request():
     """flask session setup - database and metrics"""
-    g.db = database.get_session()
-    g.session = SessionManager()
     g.request_start_time = utcnow()
     try:
-        resource = request.url_rule.rule.split('/')[3]
+        g.resource = resource = request.url_rule.rule.split('/')[3]
     except Exception:
-        resource = None
+        g.resource = resource = None
+    # Shed floods by client address ahead of any redis or db work
+    g.clientlimit = ClientLimit()
+    if g.clientlimit.applies(resource) and g.clientlimit.call():
+        abort(429)
+    metrics = Metrics()
+    metrics.start_sampler()
+    metrics.buffer()
+    g.db = database.get_session()
+    g.session = SessionManager()
+    if resource != 'health' and not _redis_reachable():
+        msg = 'redis cache unreachable'
+        logging.error(dict(action='before_request', status=503, error=msg))
+        abort(503, msg)
     if resource != 'metrics':
-        try:
-            Metrics().store('api_calls_total',
-                            labels=['resource=%s' % resource])
-        except redis.exceptions.ConnectionError:
-            msg = 'redis cache unreachable'
-            logging.error(dict(action='before_request', status=503, error=msg))
-            if resource != 'health':
-                abort(503, msg)
-    if request.method != 'OPTIONS' and RateLimit().call():
+        metrics.store('api_calls_total', labels=['resource=%s' % resource])
+    g.ratelimit = RateLimit()
+    if request.method != 'OPTIONS' and g.ratelimit.call():
         Metrics().store('api_errors_total', labels=['code=%d' % 429])
         abort(429)
 
 
 def after_request(response):
     """flask headers and metrics - all responses get a cache-control header"""
+    global redis_verified
+
     config = ServiceConfig().config
     response.cache_control.max_age = config.HTTP_RESPONSE_CACHE_MAX_AGE
+    for limit in ('clientlimit', 'ratelimit'):
+        if limit in g:
+            response.headers.extend(g.get(limit).headers())
+    metrics = Metrics()
+    duration = utcnow().timestamp() - g.request_start_time.timestamp()
     try:
-        Metrics().store(
-            'api_request_seconds_total', value=utcnow().timestamp() -
-            g.request_start_time.timestamp())
-    except (redis.exceptions.ConnectionError, ConnectionRefusedError):
-        pass
+        metrics.store('api_request_seconds', labels=[
+            'method=%s' % request.method, 'resource=%s' % g.get('resource'),
+            'status=%d' % response.status_code], value=duration)
+        metrics.store('api_request_seconds_total', value=duration)
+        metrics.flush()
+        redis_verified = time.monotonic()
+    except (redis.exceptions.ConnectionError, ConnectionRefusedError) as ex:
+        logging.error(dict(action='after_request', message=str(ex)))
     return response
 
 
@@ -179,3 +203,22 @@ def render_problem(error):
     return jsonify(dict(
         message=error.detail,
         error=dict(status=error.title, code=error.status))), error.status
+
+
+def _redis_reachable():
+    """Check that redis is up with a PING, unless a round trip has
+    succeeded within the last REDIS_CHECK_INTERVAL seconds
+
+    Returns:
+      bool: false if redis is unreachable
+    """
+    global redis_verified
+
+    if time.monotonic() - redis_verified < Constants.REDIS_CHECK_INTERVAL:
+        return True
+    try:
+        state.redis_conn.ping()
+    except (redis.exceptions.ConnectionError, ConnectionRefusedError):
+        return False
+    redis_verified = time.monotonic()
+    return True
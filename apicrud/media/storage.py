@@ -21,7 +21,6 @@ from flask_babel import _
 import json
 import logging
 import re
-import redis
 from sqlalchemy.orm.exc import NoResultFound
 import uuid
 
@@ -30,6 +29,7 @@ from ..access import AccessControl
 from ..const import Constants
 from ..grants import Grants
 from ..metrics import Metrics
+from ..redis_pool import redis_connect
 from ..service_config import ServiceConfig
 import apicrud.utils as utils
 
@@ -48,9 +48,7 @@ class StorageAPI(object):
                  uid=None, db_session=None):
         config = ServiceConfig().config
         self.models = ServiceConfig().models
-        self.redis_conn = (
-            redis_conn or state.redis_conn or redis.Redis(
-                host=config.REDIS_HOST, port=config.REDIS_PORT, db=0))
+        self.redis_conn = redis_conn or state.redis_conn or redis_connect()
         self.cache_ttl = config.REDIS_TTL
         self.credential_ttl = credential_ttl or 86400
         self.uid = uid or AccessControl().uid
@@ -54,6 +54,26 @@ class Confirmation:
         contact = g.db.query(self.models.Contact).filter_by(id=id).one()
         if not contact:
             return dict(id=id, message='Not Found'), 404
+        return self._send_token(contact, ttl, template), 200
+
+    def request_many(self, ids, ttl=None, template='contact_add'):
+        """Send confirmation tokens to a batch of newly-created contacts,
+        reading them in a single query
+
+        Args:
+          ids (list): record IDs in contacts table of database
+          ttl (int): how many seconds before token expires
+          template (str): jinja2 template name contact-add message
+
+        Returns:
+          dict: token and contact-ID for each contact found, keyed by ID
+        """
+        ttl = ttl or self.token_timeout
+        return {contact.id: self._send_token(contact, ttl, template)
+                for contact in g.db.query(self.models.Contact).filter(
+                    self.models.Contact.id.in_(ids))}
+
+    def _send_token(self, contact, ttl, template):
         serializer = URLSafeTimedSerializer(self.token_secret)
         if contact.type == u'sms':
             # For SMS, need to use a short token (less secure)
@@ -65,12 +85,12 @@ class Confirmation:
             contact.id, contact.info, nonce), salt=self.token_salt)
         g.session.create(contact.id, [], param=token, nonce=nonce, ttl=ttl)
         logging.info('action=confirmation_request id=%s info=%s' %
-                     (id, contact.info))
+                     (contact.id, contact.info))
         if self.func_send:
             # TODO: stop token value from leaking into celery logs
-            self.func_send(
-                to=id, template=template, token=token, type=contact.type)
-        return dict(token=token, id=id, uid=contact.uid), 200
+            self.func_send(to=contact.id, template=template, token=token,
+                           type=contact.type)
+        return dict(token=token, id=contact.id, uid=contact.uid)
 
     def confirm(self, token, clear_session=False):
         """Confirm a contact if token is still valid
@@ -3,27 +3,41 @@
 created 15-aug-2020 by docker@instantlinux.net
 """
 
-from babel.support import format_datetime, Translations
+from babel import Locale, UnknownLocaleError
+from babel.support import format_datetime, NullTranslations, \
+    Translations
 from datetime import datetime
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import make_msgid, formatdate
 import jinja2
 import logging
-from sqlalchemy.orm.exc import NoResultFound
+import threading
 
 from ..exceptions import APIcrudFormatError
+from ..profile_cache import ProfileCache
 from ..service_config import ServiceConfig
 
-jinja2Env = []
-
 
 class MessageFormat(object):
     """MIME and SMS formatting
+
+    A jinja2 environment, with translations installed, is built once
+    per locale and shared by all instances; compiled templates are kept
+    in a bytecode cache shared by all environments.
+
+    Args:
+        db_session (obj): open session to database
+        settings (obj): AccountSettings for account
+        memoize (bool): for bulk sends, render message content once per
+          locale; only the footer is rendered for each recipient
     """
+    _bytecode_cache = None
+    _environments = {}
+    _lock = threading.Lock()
 
     def __init__(self, db_session=None, account_id=None, smtp=None,
-                 settings=None):
+                 settings=None, memoize=False):
         # TODO this could be subclassed from Messaging - but causes
         # circular import exception
         self.config = ServiceConfig().config
@@ -31,6 +45,7 @@ class MessageFormat(object):
         self.models = ServiceConfig().models
         self.settings = settings
         self.siteurl = self.settings.get.url
+        self.rendered = {} if memoize else None
 
     def email(self, template, frm, sender_email, to, attachments=[], **kwargs):
         """Format an email message with mime attachment, in the user's
@@ -48,17 +63,9 @@ class MessageFormat(object):
         """
         params = dict(
             sender=frm.owner.name, **kwargs)
-        Profile = ServiceConfig().models.Profile
-        try:
-            tz = self.db_session.query(Profile).filter(
-                Profile.uid == to.uid, Profile.item == 'tz').one().value
-        except NoResultFound:
-            tz = self.settings.get.tz
-        try:
-            lang = self.db_session.query(Profile).filter(
-                Profile.uid == to.uid, Profile.item == 'lang').one().value
-        except NoResultFound:
-            lang = self.settings.get.lang
+        profile = ProfileCache(self.db_session).get(to.uid)
+        tz = profile.get('tz') or self.settings.get.tz
+        lang = profile.get('lang') or self.settings.get.lang
         if 'starts' in kwargs:
             params['starts_formatted'] = format_datetime(
                 datetime.strptime(kwargs['starts'], '%Y-%m-%dT%H:%M:%S'),
@@ -69,15 +76,18 @@ class MessageFormat(object):
             mime['Reply-To'] = '%s <%s>' % (frm.owner.name, frm.info)
         mime['To'] = '%s <%s>' % (to.owner.name, to.info)
         mime['Date'] = formatdate()
-        mime['Subject'] = self._render_template(template, lang,
-                                                selector='subject', **kwargs)
+        tz_key = tz if 'starts' in kwargs else None
+        mime['Subject'] = self._render_shared(template, lang, tz_key,
+                                              selector='subject', **kwargs)
         mime['Message-ID'] = make_msgid()
         mime.attach(MIMEText(
-            self._render_template(template, lang, selector='email', **params) +
+            self._render_shared(template, lang, tz_key, selector='email',
+                                **params) +
             self._render_template('footer', lang, selector='email', **params),
             'plain'))
         mime.attach(MIMEText(
-            self._render_template(template, lang, selector='html', **params) +
+            self._render_shared(template, lang, tz_key, selector='html',
+                                **params) +
             self._render_template('footer', lang, selector='html', **params),
             'html'))
         for item in attachments:
@@ -95,14 +105,32 @@ class MessageFormat(object):
         Returns:
             str: Formatted string content
         """
-        Profile = ServiceConfig().models.Profile
-        try:
-            lang = self.db_session.query(Profile).filter(
-                Profile.uid == to.uid, Profile.item == 'lang').one().value
-        except NoResultFound:
-            lang = self.settings.get.lang
-        return self._render_template(template, lang, selector='sms',
-                                     sender=frm.owner.name, **kwargs)
+        lang = ProfileCache(self.db_session).get(
+            to.uid, 'lang') or self.settings.get.lang
+        return self._render_shared(template, lang, None, selector='sms',
+                                   sender=frm.owner.name, **kwargs)
+
+    def _render_shared(self, template_name, locale, tz, **kwargs):
+        """Render content which is the same for all recipients in a
+        locale; when memoizing, it's rendered once per locale and time
+        zone, without per-recipient values (contact_id)
+
+        Args:
+            template_name (str): filename of template (without .j2)
+            locale (str): language/locale string
+            tz (str): time zone, if the content depends on it
+            kwargs: key/value pairs for template expansion
+        Returns:
+            str: Rendered content
+        """
+        if self.rendered is None:
+            return self._render_template(template_name, locale, **kwargs)
+        key = (template_name, kwargs.get('selector'), locale, tz)
+        if key not in self.rendered:
+            kwargs.pop('contact_id', None)
+            self.rendered[key] = self._render_template(
+                template_name, locale, **kwargs)
+        return self.rendered[key]
 
     def _render_template(self, template_name, locale, **kwargs):
         """Scan the configured template_folders path looking for the
@@ -118,27 +146,54 @@ class MessageFormat(object):
         Raises:
             APIcrudFormatError: template not found
         """
-        global jinja2Env
-
-        config = ServiceConfig().config
-        trans = []
-        for dir in config.BABEL_TRANSLATION_DIRECTORIES.split(';'):
-            trans.append(Translations.load(dir, locale))
-        if not jinja2Env:
-            for folder in config.TEMPLATE_FOLDERS:
-                jinja2Env.append(jinja2.Environment(
-                    loader=jinja2.FileSystemLoader(searchpath=folder),
-                    extensions=['jinja2.ext.i18n']
-                ))
-
         kwargs.update(dict(siteurl=self.siteurl, appname=self.config.APPNAME))
-        for env in jinja2Env:
-            try:
-                for x in trans:
-                    env.install_gettext_translations(x)
-                return env.get_template(template_name + '.j2').render(**kwargs)
-            except jinja2.exceptions.TemplateNotFound:
-                continue
-        logging.error(dict(message='template not found',
-                           template=template_name))
-        raise APIcrudFormatError('template=%s not found' % template_name)
+        try:
+            return self._environment(locale).get_template(
+                template_name + '.j2').render(**kwargs)
+        except jinja2.exceptions.TemplateNotFound:
+            logging.error(dict(message='template not found',
+                               template=template_name))
+            raise APIcrudFormatError('template=%s not found' % template_name)
+
+    def _environment(self, locale):
+        """Get the jinja2 environment for a locale, creating it on
+        first use; translations from all of the configured directories
+        are merged, later ones taking precedence. The locale comes from
+        a user's profile, so it is normalized to one that babel knows,
+        falling back to babel_default_locale; this bounds the number of
+        environments held.
+
+        Args:
+            locale (str): language/locale string
+        Returns:
+            obj: jinja2 Environment
+        """
+        try:
+            locale = str(Locale.parse(locale.replace('-', '_')))
+        except (AttributeError, TypeError, UnknownLocaleError, ValueError):
+            locale = self.config.BABEL_DEFAULT_LOCALE
+        env = self._environments.get(locale)
+        if env:
+            return env
+        with self._lock:
+            if locale in self._environments:
+                return self._environments[locale]
+            if not MessageFormat._bytecode_cache:
+                MessageFormat._bytecode_cache = (
+                    jinja2.FileSystemBytecodeCache(
+                        directory=self.config.TEMPLATE_BYTECODE_DIR or None))
+            trans = NullTranslations()
+            for dir in self.config.BABEL_TRANSLATION_DIRECTORIES.split(';'):
+                loaded = Translations.load(dir, locale)
+                if isinstance(loaded, Translations):
+                    trans = trans.merge(loaded) if isinstance(
+                        trans, Translations) else loaded
+            env = jinja2.Environment(
+                loader=jinja2.ChoiceLoader([
+                    jinja2.FileSystemLoader(searchpath=folder)
+                    for folder in self.config.TEMPLATE_FOLDERS]),
+                extensions=['jinja2.ext.i18n'],
+                bytecode_cache=MessageFormat._bytecode_cache)
+            env.install_gettext_translations(trans)
+            self._environments[locale] = env
+        return env
@@ -7,6 +7,8 @@ import celery
 from flask_babel import _
 import logging
 import smtplib
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import contains_eager
 from sqlalchemy.orm.exc import NoResultFound
 import ssl
 
@@ -14,6 +16,7 @@ from ..account_settings import AccountSettings
 from ..database import get_session
 from ..exceptions import APIcrudSendError
 from ..metrics import Metrics
+from ..profile_cache import ProfileCache
 from ..service_config import ServiceConfig
 from ..utils import utcnow
 from .format import MessageFormat
@@ -95,30 +98,27 @@ class Messaging(object):
             logging.info('action=send_contact template=%s type=%s address=%s' %
                          (template, to_contact.type, to_contact.info))
             metrics = Metrics(uid=frm, db_session=self.db_session)
-            if to_contact.type == 'sms':
-                if (not metrics.store('sms_daily_total') or
-                        not metrics.store('sms_monthly_total')):
-                    msg = _(u'daily limit exceeded')
-                    logging.info(dict(message=msg, **logmsg))
-                    raise APIcrudSendError(msg)
-                dest_email = (to_contact.info + '@' +
-                              self.config.CARRIER_GATEWAYS[to_contact.carrier])
-                body = MessageFormat(db_session=self.db_session,
-                                     settings=self.settings).sms(
-                    template, from_contact, to_contact, **kwargs)
-            else:
-                if (not metrics.store('email_daily_total') or
-                        not metrics.store('email_monthly_total')):
-                    msg = _(u'daily limit exceeded')
-                    logging.info(dict(message=msg, **logmsg))
-                    raise APIcrudSendError(msg)
-                dest_email = to_contact.info
-                body = MessageFormat(db_session=self.db_session,
-                                     settings=self.settings).email(
-                    template, from_contact, sender_email,
-                    to_contact, attachments=attachments,
-                    contact_id=to_contact.id, **kwargs).as_string()
-            self.smtp.sendmail(sender_email, dest_email, body)
+            grants = ('%s_daily_total' % to_contact.type,
+                      '%s_monthly_total' % to_contact.type)
+            reserved = []
+            try:
+                for grant in grants:
+                    if not metrics.store(grant):
+                        msg = _(u'daily limit exceeded')
+                        logging.info(dict(message=msg, **logmsg))
+                        raise APIcrudSendError(msg)
+                    reserved.append(grant)
+                dest_email, body = self._format(
+                    MessageFormat(db_session=self.db_session,
+                                  settings=self.settings),
+                    template, from_contact, sender_email, to_contact,
+                    attachments=attachments, **kwargs)
+                self._sendmail(sender_email, dest_email, body)
+            except Exception:
+                # Give back credit taken for a message that wasn't sent
+                for grant in reserved:
+                    metrics.refund(grant, 1)
+                raise
             to_contact.last_attempted = utcnow()
             self.db_session.add(to_contact)
         else:
@@ -128,6 +128,101 @@ class Messaging(object):
             raise APIcrudSendError('unsupported type=%s' % to_contact.type)
         self.db_session.commit()
 
+    def send_bulk(self, recipients, template, frm=None, to_uids=None,
+                  attachments=[], **kwargs):
+        """
+        Send a message to many contacts: recipients are fetched in a
+        single query, content is rendered once per locale, usage is
+        metered once per contact type, and messages are delivered over
+        one SMTP connection
+
+        Args:
+            recipients (list): IDs of Contact records
+            template (str): jinja2 template name
+            frm (uid): person
+            to_uids (list): uids of people, to reach at primary contact
+            attachments (list): additional MIMEBase / MimeText objects
+            kwargs: kv pairs
+        Returns:
+            int: number of messages sent
+        Raises:
+            APIcrudSendError
+        """
+        Contact, Person = self.models.Contact, self.models.Person
+        logmsg = dict(action='send_bulk', from_id=frm, template=template)
+        conditions = []
+        if recipients:
+            conditions.append(Contact.id.in_(recipients))
+        if to_uids:
+            conditions.append(and_(
+                Contact.info == Person.identity, Contact.type == 'email',
+                Contact.status == 'active', Person.id.in_(to_uids)))
+        if not conditions:
+            return 0
+        contacts = self.db_session.query(Contact).join(
+            Contact.owner).options(contains_eager(Contact.owner)).filter(
+                or_(*conditions)).all()
+        missing = set(recipients or []) - set(item.id for item in contacts)
+        if missing:
+            logging.warning(dict(message='recipients not found',
+                                 missing=sorted(missing), **logmsg))
+        by_type = {}
+        for contact in contacts:
+            if contact.status == 'disabled':
+                continue
+            elif contact.type not in ('email', 'sms'):
+                logging.warning(dict(message='Unsupported type',
+                                     contact_type=contact.type, **logmsg))
+                continue
+            by_type.setdefault(contact.type, []).append(contact)
+        ProfileCache(self.db_session).load(
+            set(contact.uid for contact in contacts))
+        formatter = MessageFormat(db_session=self.db_session,
+                                  settings=self.settings, memoize=True)
+        sent = 0
+        try:
+            for type, items in by_type.items():
+                uid, from_contact = self._get_frm(frm, items[0])
+                if from_contact.info in self.settings.get.approved_senders:
+                    sender_email = from_contact.info
+                else:
+                    sender_email = self.settings.get.sender_email
+                metrics = Metrics(uid=uid, db_session=self.db_session)
+                daily, monthly = ('%s_daily_total' % type,
+                                  '%s_monthly_total' % type)
+                reserved = metrics.reserve(daily, len(items))
+                allowed = metrics.reserve(monthly, reserved)
+                metrics.refund(daily, reserved - allowed)
+                if allowed < len(items):
+                    logging.info(dict(message=_(u'daily limit exceeded'),
+                                      type=type, allowed=allowed,
+                                      count=len(items), **logmsg))
+                delivered = 0
+                try:
+                    for to_contact in items[:allowed]:
+                        dest_email, body = self._format(
+                            formatter, template, from_contact, sender_email,
+                            to_contact, attachments=attachments, **kwargs)
+                        try:
+                            self._sendmail(sender_email, dest_email, body)
+                        except smtplib.SMTPException as ex:
+                            logging.warning(dict(
+                                message=str(ex), to=dest_email, **logmsg))
+                            continue
+                        to_contact.last_attempted = utcnow()
+                        delivered += 1
+                        sent += 1
+                finally:
+                    # Give back credit reserved for messages not sent
+                    if delivered < allowed:
+                        for grant in (daily, monthly):
+                            metrics.refund(grant, allowed - delivered)
+        finally:
+            # Record progress even if delivery is interrupted
+            logging.info(dict(count=sent, **logmsg))
+            self.db_session.commit()
+        return sent
+
     def smtp_session(self):
         """Open an SMTP connection to the account's defined smtp_smarthost
 
@@ -151,6 +246,49 @@ class Messaging(object):
                 raise APIcrudSendError('Credential problem: %s' % str(ex))
         return session
 
+    def _format(self, formatter, template, from_contact, sender_email,
+                to_contact, attachments=[], **kwargs):
+        """Format a message for the to_contact's type
+
+        Args:
+            formatter (obj): MessageFormat instance
+            template (str): jinja2 template name
+            from_contact (obj): Contact record of sender
+            sender_email (str): envelope sender
+            to_contact (obj): Contact record of recipient
+            attachments (list): additional MIMEBase / MimeText objects
+            kwargs: kv pairs
+        Returns: tuple
+            dest_email (str): destination address
+            body (str): message content
+        """
+        if to_contact.type == 'sms':
+            return (to_contact.info + '@' +
+                    self.config.CARRIER_GATEWAYS[to_contact.carrier],
+                    formatter.sms(template, from_contact, to_contact,
+                                  **kwargs))
+        return to_contact.info, formatter.email(
+            template, from_contact, sender_email, to_contact,
+            attachments=attachments, contact_id=to_contact.id,
+            **kwargs).as_string()
+
+    def _sendmail(self, sender_email, dest_email, body):
+        """Send over the open SMTP connection, reconnecting once if
+        the smarthost has dropped it
+
+        Args:
+            sender_email (str): envelope sender
+            dest_email (str): destination address
+            body (str): message content
+        """
+        if not self.smtp:
+            self.smtp = self.smtp_session()
+        try:
+            self.smtp.sendmail(sender_email, dest_email, body)
+        except smtplib.SMTPServerDisconnected:
+            self.smtp = self.smtp_session()
+            self.smtp.sendmail(sender_email, dest_email, body)
+
     def _get_settings(self, model, account_id=None):
         if account_id is None:
             try:
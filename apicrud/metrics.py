@@ -5,20 +5,85 @@ Metrics and usage tracking
 created 21-feb-2021 by richb@instantlinux.net
 """
 
+from flask import g, has_request_context, Response
 from flask_babel import _
+from fnmatch import fnmatchcase
 import json
 import logging
 import os
+import socket
+import threading
+import time
 
-from . import state
+from . import database, state
 from .access import AccessControl
 from .const import Constants
 from .grants import Grants
+from .redis_pool import call_script, pool_stats
 from .service_config import ServiceConfig
 from .service_registry import ServiceRegistry
 
 INTERVALS = dict(hour=3600, day=3600 * 24, week=3600 * 24 * 7,
                  month=3600 * 24 * 31, indefinite=None)
+MGET_BATCH = 1000
+OBSERVED_STYLES = ('histogram', 'summary')
+
+# Atomic check-and-decrement of a grant counter
+#  KEYS[1]: metric key, KEYS[2]: index; ARGV: limit, expiration seconds
+#  (0 for none), notify percentage (0 for none), labels
+#  Returns: {remaining credit or -1 if exhausted, 1 if notify crossed}
+GRANT_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local amount = tonumber(ARGV[5])
+local current = tonumber(redis.call('GET', KEYS[1]))
+if current == nil or current >= limit then
+  redis.call('SADD', KEYS[2], ARGV[4])
+  local granted = math.max(math.min(amount, limit), 0)
+  local remaining = limit - math.max(granted, 1)
+  if tonumber(ARGV[2]) > 0 then
+    redis.call('SET', KEYS[1], remaining, 'EX', ARGV[2])
+  else
+    redis.call('SET', KEYS[1], remaining)
+  end
+  return {remaining, 0, granted}
+elseif current <= 0 then
+  return {-1, 0, 0}
+end
+local granted = math.min(amount, current)
+local remaining = redis.call('DECRBY', KEYS[1], granted)
+local notify = tonumber(ARGV[3])
+local crossed = 0
+if notify > 0 and current / limit * 100 >= 100 - notify and
+    remaining / limit * 100 < 100 - notify then
+  crossed = 1
+end
+return {remaining, crossed, granted}
+"""
+
+# Drop index members whose series has expired; run as a script so that
+# it can't interleave with GRANT_SCRIPT recreating the series
+#  KEYS: pairs of index, metric key; ARGV: labels, one per pair
+PRUNE_SCRIPT = """
+for i = 1, #ARGV do
+  if redis.call('EXISTS', KEYS[2 * i]) == 0 then
+    redis.call('SREM', KEYS[2 * i - 1], ARGV[i])
+  end
+end
+return 0
+"""
+
+# Return units to a grant counter, unless its period has expired
+#  KEYS[1]: metric key; ARGV[1]: units
+#  Returns: remaining credit, or -1 if the key has expired
+REFUND_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+  return redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+return -1
+"""
+BACKFILL_KEY = 'mti:_backfilled'
+BACKFILL_LOCK = 'mti:_backfilling'
+BACKFILL_LOCK_TTL = 600
 
 
 class Metrics(object):
@@ -30,6 +95,21 @@ class Metrics(object):
     https://www.infoworld.com/article/3230455/how-to-use-redis-for-real-time-metering-applications.html
     The data store is in-memory, with snapshot/append persistence to disk.
 
+    Each metric name has an index, a redis set mti:<name> of the label
+    sets stored under it, so that lookups cost a couple of round trips
+    proportional to the number of series rather than a scan of the
+    whole keyspace.
+
+    Process metrics (process_xxx, redis_pool_xxx, db_pool_xxx) are
+    sampled by a background thread in each worker process every
+    config.METRICS_PROCESS_INTERVAL seconds, so that find and collect only
+    read from redis.
+
+    Histogram and summary observations are accumulated within the process
+    and flushed at most every config.METRICS_FLUSH_INTERVAL seconds into
+    a redis hash per series, holding a count per bucket upper bound (le)
+    along with sum and count.
+
     All metrics are defined in the metrics section of service_config.yaml.
     These follow a de facto standard described in best-practices
     documentation section of prometheus.io website. At time of implementation,
@@ -54,6 +134,11 @@ class Metrics(object):
       db_session (obj): existing db connection
       func_send (obj): function name for sending message via celery
     """
+    _flushed = 0
+    _lock = threading.Lock()
+    _observations = {}
+    _sampler_pid = None
+
     def __init__(self, uid=None, db_session=None, func_send=None):
         self.config = config = ServiceConfig().config
         self.connection = state.redis_conn
@@ -70,7 +155,8 @@ class Metrics(object):
         Params:
           name (str): a metric name
           labels (list): labels, usually in form <label>=<value>
-          value (int or float): value to store
+          value (int or float): value to store, or to observe for
+            histogram and summary styles
 
         Returns:
           bool: true in all cases except for grant exceeded
@@ -79,45 +165,130 @@ class Metrics(object):
             raise AssertionError('name=%s not defined in config' % name)
 
         metric = self.metrics[name]
-        if not labels:
-            if metric['scope'] == 'instance':
-                labels = ['instance=%s' % ServiceRegistry().get()['id']]
-            else:
-                labels = ['uid=%s' % self.uid] if self.uid else []
-        labels.sort()
+        labels = self._labels(metric, labels)
         key = 'mtr:%s:%s' % (name, ",".join(labels))
         if metric['style'] == 'grant':
-            current = self.connection.get(key)
-            limit = Grants(db_session=self.db_session).get(name, uid=self.uid)
-            if current is None or int(current) >= limit:
-                self.connection.set(key, limit - 1,
-                                    ex=INTERVALS[metric['period']])
-            elif int(current) <= 0:
+            if not self._grant_decr(name, labels, metric):
                 return False
-            else:
-                if metric['notify'] and self.func_send:
-                    used = float(current) / limit * 100
-                    used_next = (float(current) - 1.0) / limit * 100
-                    if ((used >= 100 - metric['notify']) and
-                            (used_next < 100 - metric['notify'])):
-                        self.func_send(
-                            to_uid=self.uid, template='usage_notify',
-                            percent=metric['notify'], period=metric['period'],
-                            resource=name)
-                self.connection.decr(key)
-        elif metric['style'] == 'counter':
-            if type(value) is int:
-                self.connection.incrby(key, value)
+        elif metric['style'] in ('counter', 'gauge'):
+            if metric['style'] == 'counter' and type(value) not in (
+                    int, float, type(None)):
+                raise AssertionError('Invalid value')
+            pipe = self._buffer()
+            if metric['style'] == 'gauge':
+                pipe.set(key, value)
+            elif type(value) is int:
+                pipe.incrby(key, value)
             elif type(value) is float:
-                self.connection.incrbyfloat(key, value)
-            elif value is None:
-                self.connection.incr(key)
+                pipe.incrbyfloat(key, value)
             else:
+                pipe.incr(key)
+            pipe.sadd('mti:%s' % name, ",".join(labels))
+            if not has_request_context() or pipe is not g.get(
+                    'metrics_pipe'):
+                pipe.execute()
+        elif metric['style'] in OBSERVED_STYLES:
+            if type(value) not in (int, float):
                 raise AssertionError('Invalid value')
-        elif metric['style'] == 'gauge':
-            self.connection.set(key, value)
+            self._observe(name, ",".join(labels), metric, value)
         return True
 
+    def reserve(self, name, count, labels=[]):
+        """Take up to count units of a grant's remaining credit in a
+        single round trip, for batch operations such as bulk messaging
+
+        Params:
+          name (str): a metric name, of grant style
+          count (int): units requested
+          labels (list): labels, usually in form <label>=<value>
+
+        Returns:
+          int: units granted, fewer than count if credit ran out
+        """
+        if self.metrics.get(name, {}).get('style') != 'grant':
+            raise AssertionError('name=%s not a grant in config' % name)
+        if count <= 0:
+            return 0
+        metric = self.metrics[name]
+        return self._grant_decr(name, self._labels(metric, labels), metric,
+                                amount=count)
+
+    def refund(self, name, count, labels=[]):
+        """Give back units taken by reserve() which went unused; nothing
+        is refunded if the grant period has since expired
+
+        Params:
+          name (str): a metric name, of grant style
+          count (int): units to return
+          labels (list): labels, usually in form <label>=<value>
+        """
+        if self.metrics.get(name, {}).get('style') != 'grant':
+            raise AssertionError('name=%s not a grant in config' % name)
+        if count <= 0:
+            return
+        key = 'mtr:%s:%s' % (name, ",".join(
+            self._labels(self.metrics[name], labels)))
+        call_script(self.connection, REFUND_SCRIPT, keys=[key], args=[count])
+
+    def buffer(self):
+        """Start buffering counter and gauge metrics for the current
+        request; they are sent to redis in a single pipeline by flush()
+        """
+        g.metrics_pipe = self.connection.pipeline(transaction=False)
+
+    def flush(self):
+        """Send metrics buffered during the current request, along with
+        histogram and summary observations if the flush interval is up
+
+        Raises:
+          redis.exceptions.ConnectionError: if redis is unreachable
+        """
+        pipe = g.pop('metrics_pipe', None) if has_request_context() else None
+        interval = self.config.METRICS_FLUSH_INTERVAL
+        if (self._observations and
+                time.monotonic() - Metrics._flushed >= interval):
+            self._send_observations(
+                pipe or self.connection.pipeline(transaction=False))
+        elif pipe:
+            pipe.execute()
+
+    def start_sampler(self):
+        """Start the process-metrics sampler thread, unless it is already
+        running in this process. A worker forked from a parent that
+        started it gets its own. The first sample is taken immediately.
+        """
+        interval = self.config.METRICS_PROCESS_INTERVAL
+        if not interval or Metrics._sampler_pid == os.getpid():
+            return
+        with self._lock:
+            if Metrics._sampler_pid == os.getpid():
+                return
+            Metrics._sampler_pid = os.getpid()
+        self._sample()
+        threading.Thread(target=self._sampler, args=(interval,),
+                         daemon=True).start()
+
+    def backfill_index(self):
+        """Add series stored before the per-name indexes existed to
+        the indexes; this runs once per redis instance, on the first
+        startup after upgrade. It is marked complete only once the scan
+        has finished; a process which dies partway releases its lock by
+        expiry, and a later startup runs it again.
+        """
+        if self.connection.exists(BACKFILL_KEY) or not self.connection.set(
+                BACKFILL_LOCK, os.getpid(), nx=True, ex=BACKFILL_LOCK_TTL):
+            return
+        pipe = self.connection.pipeline(transaction=False)
+        for key in self.connection.scan_iter(match='mtr:*', count=MGET_BATCH):
+            name, labels = key.decode().split(':', 2)[1:]
+            if name in self.metrics:
+                pipe.sadd('mti:%s' % name, labels)
+            if len(pipe) >= MGET_BATCH:
+                pipe.execute()
+        pipe.set(BACKFILL_KEY, 1)
+        pipe.delete(BACKFILL_LOCK)
+        pipe.execute()
+
     def check(self, name):
         """Check remaining credit against grant-style metric
 
@@ -168,7 +339,6 @@ class Metrics(object):
                 label = filter.get('label') or kwargs.get('label', '*')
                 if label != '*':
                     label = '*%s*' % label
-            self._process_collect()
         elif 'user' in auth:
             uid = filter.get('uid')
             if not uid or uid != acc.uid:
@@ -176,23 +346,22 @@ class Metrics(object):
             label = 'uid=%s' % uid
         else:
             return dict(message=_(u'access denied')), 403
-        key = 'mtr:%s:%s' % (name, label)
         limit = kwargs.get('limit', Constants.PER_PAGE_DEFAULT)
         offset = kwargs.get('offset', 0)
         count, retval = 0, []
-        for item in self.connection.scan_iter(match=key):
+        self._send_observations(
+            self.connection.pipeline(transaction=False))
+        for name, labels, value in self._series(name, label):
             if offset:
                 offset -= 1
             else:
-                value = self.connection.get(item).decode()
-                try:
-                    value = int(value)
-                except ValueError:
-                    value = float(value)
-                retval.append(dict(
-                    name=item.decode().split(':')[1],
-                    labels=item.decode().split(':')[2].split(','),
-                    value=value))
+                if type(value) is dict:
+                    value = {field: self._number(val)
+                             for field, val in value.items()}
+                else:
+                    value = self._number(value.decode())
+                retval.append(dict(name=name, labels=labels.split(','),
+                                   value=value))
             count += 1
             if count >= limit:
                 break
@@ -202,14 +371,15 @@ class Metrics(object):
         """
         Prometheus-compatible metrics exporter. Collects current
         metrics from redis, evaluates metric-type settings in
-        service_config.yaml, and returns a plain-text result in this form:
+        service_config.yaml, and streams a plain-text result in this form,
+        with samples grouped under one HELP/TYPE header per metric name:
 
-        # TYPE process_resident_memory_bytes gauge
-        process_resident_memory_bytes{instance="k8s-01.ci.net"} 20576.0
-        # TYPE process_start_time_seconds gauge
-        process_start_time_seconds{instance="k8s-01.ci.net"} 1614051156.14
         # TYPE api_calls_total counter
         api_calls_total{resource="person"} 4
+        api_calls_total{resource="settings"} 2
+        # HELP process_resident_memory_bytes Resident memory size
+        # TYPE process_resident_memory_bytes gauge
+        process_resident_memory_bytes{instance="k8s-01.ci.net"} 20576.0
         """
         try:
             filter = json.loads(kwargs.get('filter', '{}'))
@@ -226,39 +396,276 @@ class Metrics(object):
             label = filter.get('label') or kwargs.get('label', '*')
             if label != '*':
                 label = '*%s*' % label
-        self._process_collect()
-        key = 'mtr:%s:%s' % (name, label)
-        limit = kwargs.get('limit', Constants.PER_PAGE_DEFAULT)
-        count, retval = 0, []
-        for item in self.connection.scan_iter(match=key):
-            name = item.decode().split(':')[1]
-            if name not in self.metrics:
-                continue
-            type_ = self.metrics[name]['style']
+        self._send_observations(
+            self.connection.pipeline(transaction=False))
+        # No default limit: a scrape has to see every series
+        limit = kwargs.get('limit')
+        # Streamed without request context: the generator reads only redis
+        return Response(self._exposition(name, label, limit), status=200,
+                        mimetype='text/plain; version=0.0.4')
+
+    def _exposition(self, name, label, limit):
+        """Generator for prometheus text exposition format
+
+        Params:
+          name (str): metric name or glob pattern
+          label (str): glob pattern to match against label set
+          limit (int): maximum number of series, or None
+
+        Yields:
+          str: header or sample lines
+        """
+        count, family = 0, None
+        for name, labels, value in self._series(name, label):
+            metric = self.metrics[name]
+            type_ = metric['style']
             if type_ == 'grant':
                 # TODO decide better way to filter out style=grant
                 if 'uid' not in label:
                     continue
                 type_ = 'gauge'
-            retval.append(dict(name=name, type_=type_,
-                               labels=item.decode().split(':')[2].split(','),
-                               value=self.connection.get(item).decode()))
+            if name != family:
+                family = name
+                if metric.get('help'):
+                    yield '# HELP %s %s\n' % (name, metric['help'].replace(
+                        '\\', r'\\').replace('\n', r'\n'))
+                yield '# TYPE %s %s\n' % (name, type_)
+            pairs = ['%s="%s"' % (item.split('=', 1)[0], self._escape(
+                item.split('=', 1)[1])) if '=' in item else item
+                for item in labels.split(',') if item]
+            if type_ in OBSERVED_STYLES:
+                for line in self._observed_lines(name, metric, pairs, value):
+                    yield line
+            else:
+                yield '%s%s %s\n' % (
+                    name, '{%s}' % ','.join(pairs) if pairs else '',
+                    value.decode())
             count += 1
-            if count >= limit:
+            if limit and count >= limit:
                 break
-        output = ""
-        for item in retval:
-            output += "# TYPE %s %s\n" % (item['name'], item['type_'])
-            labels = ['%s="%s"' % (label.split('=')[0], label.split('=')[1])
-                      if '=' in label else label
-                      for label in item['labels']]
-            output += "%s%s %s\n" % (
-                item['name'],
-                '{%s}' % ','.join(labels) if labels else '', item['value'])
-        return output, 200
+
+    @staticmethod
+    def _observed_lines(name, metric, pairs, fields):
+        """Exposition lines for a histogram or summary series: cumulative
+        _bucket counts (histogram only), then _sum and _count
+
+        Params:
+          name (str): metric name
+          metric (dict): metric definition
+          pairs (list): formatted label pairs
+          fields (dict): stored per-bucket counts, sum and count
+
+        Returns:
+          list of str
+        """
+        ret = []
+        if metric['style'] == 'histogram':
+            cumulative = 0
+            for bound in metric['buckets']:
+                cumulative += int(fields.get(str(bound), 0))
+                ret.append('%s_bucket{%s} %d\n' % (
+                    name, ','.join(pairs + ['le="%s"' % bound]), cumulative))
+            ret.append('%s_bucket{%s} %s\n' % (
+                name, ','.join(pairs + ['le="+Inf"']), fields['count']))
+        labels = '{%s}' % ','.join(pairs) if pairs else ''
+        ret.append('%s_sum%s %s\n' % (name, labels, fields['sum']))
+        ret.append('%s_count%s %s\n' % (name, labels, fields['count']))
+        return ret
+
+    @staticmethod
+    def _escape(value):
+        """Escape a label value for prometheus exposition"""
+        return value.replace('\\', r'\\').replace('"', r'\"').replace(
+            '\n', r'\n')
+
+    def _series(self, name, label):
+        """Look up stored series from the per-name indexes: one pipelined
+        read of the index sets, then values via MGET in batches. Index
+        entries whose keys have expired are dropped, unless the series
+        has been written again in the meantime. Series are always
+        written before being added to the index.
+
+        Params:
+          name (str): metric name or glob pattern
+          label (str): glob pattern to match against label set
+
+        Yields:
+          tuple (name, labels, value) in order of name and labels
+        """
+        names = sorted(item for item in self.metrics
+                       if fnmatchcase(item, name))
+        pipe = self.connection.pipeline(transaction=False)
+        for item in names:
+            pipe.smembers('mti:%s' % item)
+        series = sorted(
+            (item, labels.decode()) for item, members in zip(
+                names, pipe.execute()) for labels in members
+            if fnmatchcase(labels.decode(), label))
+        for start in range(0, len(series), MGET_BATCH):
+            batch = series[start:start + MGET_BATCH]
+            keys = ['mtr:%s:%s' % (item, labels) for item, labels in batch]
+            observed = [self.metrics[item]['style'] in OBSERVED_STYLES
+                        for item, labels in batch]
+            values = [key for key, hashed in zip(keys, observed)
+                      if not hashed]
+            if values:
+                values = self.connection.mget(values)
+            if any(observed):
+                read = self.connection.pipeline(transaction=False)
+                for key, hashed in zip(keys, observed):
+                    if hashed:
+                        read.hgetall(key)
+                hashes = iter(read.execute())
+            values = iter(values)
+            expired = []
+            for (item, labels), hashed in zip(batch, observed):
+                if hashed:
+                    value = {field.decode(): val.decode()
+                             for field, val in next(hashes).items()} or None
+                else:
+                    value = next(values)
+                if value is None:
+                    expired.append((item, labels))
+                else:
+                    yield item, labels, value
+            if expired:
+                call_script(self.connection, PRUNE_SCRIPT, keys=[
+                    key for item, labels in expired for key in (
+                        'mti:%s' % item, 'mtr:%s:%s' % (item, labels))],
+                    args=[labels for item, labels in expired])
+
+    def _grant_decr(self, name, labels, metric, amount=1):
+        """Decrement remaining credit of a grant in a single round trip
+        to redis, via a server-side script which is atomic under
+        concurrent requests; sends a usage notification if the notify
+        threshold was crossed
+
+        Params:
+          name (str): a metric name
+          labels (list): sorted labels
+          metric (dict): metric definition
+          amount (int): units to take
+
+        Returns:
+          int: units granted, up to amount (0 if credit is exhausted)
+        """
+        limit = Grants(db_session=self.db_session).get(name, uid=self.uid)
+        remaining, crossed, granted = call_script(
+            self.connection, GRANT_SCRIPT,
+            keys=['mtr:%s:%s' % (name, ",".join(labels)), 'mti:%s' % name],
+            args=[limit, INTERVALS[metric['period']] or 0,
+                  metric['notify'] or 0, ",".join(labels), amount])
+        if crossed and self.func_send:
+            self.func_send(
+                to_uid=self.uid, template='usage_notify',
+                percent=metric['notify'], period=metric['period'],
+                resource=name)
+        return int(granted)
+
+    def _labels(self, metric, labels):
+        """Default labels of a metric, by scope
+
+        Params:
+          metric (dict): metric definition
+          labels (list): labels specified by caller
+
+        Returns:
+          list: sorted labels
+        """
+        if not labels:
+            if metric['scope'] == 'instance':
+                labels = [self._instance_label()]
+            else:
+                labels = ['uid=%s' % self.uid] if self.uid else []
+        return sorted(labels)
+
+    def _observe(self, name, labels, metric, value):
+        """Accumulate a histogram or summary observation in process memory
+        until the next flush
+
+        Params:
+          name (str): a metric name
+          labels (str): sorted, comma-separated labels
+          metric (dict): metric definition
+          value (int or float): observed value
+        """
+        with self._lock:
+            fields = Metrics._observations.setdefault((name, labels), {})
+            if metric['style'] == 'histogram':
+                bound = next((str(bound) for bound in metric['buckets']
+                              if value <= bound), '+Inf')
+                fields[bound] = fields.get(bound, 0) + 1
+            fields['count'] = fields.get('count', 0) + 1
+            fields['sum'] = fields.get('sum', 0.0) + float(value)
+
+    def _send_observations(self, pipe):
+        """Add accumulated observations to a redis pipeline and execute
+        it; if that fails, the observations are put back for the next
+        flush rather than discarded
+
+        Params:
+          pipe (obj): redis pipeline
+        Raises:
+          redis.exceptions.ConnectionError: if redis is unreachable
+        """
+        with self._lock:
+            observations = Metrics._observations
+            Metrics._observations = {}
+        for (name, labels), fields in observations.items():
+            key = 'mtr:%s:%s' % (name, labels)
+            for field, value in fields.items():
+                if type(value) is float:
+                    pipe.hincrbyfloat(key, field, value)
+                else:
+                    pipe.hincrby(key, field, value)
+            pipe.sadd('mti:%s' % name, labels)
+        try:
+            pipe.execute()
+        except Exception:
+            with self._lock:
+                for item, fields in observations.items():
+                    merged = Metrics._observations.setdefault(item, {})
+                    for field, value in fields.items():
+                        merged[field] = merged.get(field, 0) + value
+            raise
+        Metrics._flushed = time.monotonic()
+
+    @staticmethod
+    def _number(value):
+        try:
+            return int(value)
+        except ValueError:
+            return float(value)
+
+    def _buffer(self):
+        """Returns the request's metrics pipeline if buffering,
+        otherwise a new pipeline to be executed by the caller
+        """
+        if has_request_context() and 'metrics_pipe' in g:
+            return g.metrics_pipe
+        return self.connection.pipeline(transaction=False)
+
+    def _sampler(self, interval):
+        """Sampler thread loop
+
+        Params:
+          interval (int): seconds between samples
+        """
+        while Metrics._sampler_pid == os.getpid():
+            time.sleep(interval)
+            self._sample()
+
+    def _sample(self):
+        try:
+            self._process_collect()
+            # Processes without requests (celery workers) flush here
+            self.flush()
+        except Exception as ex:
+            logging.error(dict(action='metrics.sampler', message=str(ex)))
 
     def _process_collect(self):
-        """Collect metrics for process_xxx"""
+        """Collect metrics for process_xxx, redis_pool_xxx and db_pool_xxx,
+        stored in one pipeline"""
 
         proc = '/proc/self'
         boot_timestamp = self._boot_time()
@@ -281,14 +688,29 @@ class Metrics(object):
         except (ValueError, TypeError, AttributeError, OSError):
             ticks = 100.0
 
-        self.store('process_cpu_seconds_total',
-                   value=(float(stats[11]) + float(stats[12])) / ticks)
-        self.store('process_max_fds', value=max_fds)
-        self.store('process_open_fds', value=len(os.listdir('%s/fd' % proc)))
-        self.store('process_resident_memory_bytes', value=float(stats[21]))
-        self.store('process_start_time_seconds',
-                   value=boot_timestamp + float(stats[19]) / ticks)
-        self.store('process_virtual_memory_bytes', value=float(stats[20]))
+        labels = self._instance_label()
+        pipe = self.connection.pipeline(transaction=False)
+        for name, value in [
+                ('redis_pool_connections_%s' % key, value)
+                for key, value in pool_stats(self.connection).items()] + [
+                ('db_pool_%s' % key, value)
+                for key, value in database.pool_stats().items()] + [
+                ('process_cpu_seconds_total',
+                 (float(stats[11]) + float(stats[12])) / ticks),
+                ('process_max_fds', max_fds),
+                ('process_open_fds', len(os.listdir('%s/fd' % proc))),
+                ('process_resident_memory_bytes', float(stats[21])),
+                ('process_start_time_seconds',
+                 boot_timestamp + float(stats[19]) / ticks),
+                ('process_virtual_memory_bytes', float(stats[20]))]:
+            pipe.set('mtr:%s:%s' % (name, labels), value)
+            pipe.sadd('mti:%s' % name, labels)
+        pipe.execute()
+
+    @staticmethod
+    def _instance_label():
+        return 'instance=%s' % ServiceRegistry().get().get(
+            'id', socket.gethostname())
 
     @staticmethod
     def _boot_time():
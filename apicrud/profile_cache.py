@@ -0,0 +1,88 @@
+"""profile_cache.py
+
+In-memory cache of user profile items
+"""
+
+from cachetools import TTLCache
+import threading
+
+from .service_config import ServiceConfig
+
+
+class ProfileCache(object):
+    """Per-user profile items used for localization
+
+    The lang and tz items of a user's profile are consulted on every
+    authenticated request (flask locale) and for every message
+    formatted; they're held here in memory for config.PROFILE_CACHE_TTL
+    seconds, and evicted when the profile controller writes.
+
+    Args:
+      db_session (obj): a session connected to database
+    """
+    _cache = None
+    _lock = threading.Lock()
+    items = ('lang', 'tz')
+
+    def __init__(self, db_session=None):
+        self.db_session = db_session
+        self.models = ServiceConfig().models
+        if ProfileCache._cache is None:
+            config = ServiceConfig().config
+            with ProfileCache._lock:
+                if ProfileCache._cache is None:
+                    ProfileCache._cache = TTLCache(
+                        maxsize=config.CACHE_SIZE,
+                        ttl=config.PROFILE_CACHE_TTL)
+
+    def get(self, uid, item=None):
+        """Get localization items from a user's profile
+
+        Args:
+          uid (str): User ID
+          item (str): name of an item (None to fetch all)
+        Returns:
+          dict or str: single value or dict of items found in profile
+        """
+        with self._lock:
+            values = self._cache.get(uid)
+        if values is None:
+            values = self.load([uid])[uid]
+        return values.get(item) if item else values
+
+    def load(self, uids):
+        """Fetch and cache profile items of users not already cached,
+        in a single query
+
+        Args:
+          uids (list of str): User IDs
+        Returns:
+          dict: keyed by uid, dicts of profile items
+        """
+        with self._lock:
+            found = {uid: self._cache[uid] for uid in uids
+                     if uid in self._cache}
+        missing = set(uids) - set(found)
+        if not missing:
+            return found
+        Profile, Tz = self.models.Profile, self.models.Tz
+        loaded = {uid: {} for uid in missing}
+        for uid, item, value, tz in self.db_session.query(
+                Profile.uid, Profile.item, Profile.value, Tz.name).outerjoin(
+                Tz, Tz.id == Profile.tz_id).filter(
+                Profile.uid.in_(missing), Profile.item.in_(self.items)):
+            loaded[uid][item] = value or tz
+        with self._lock:
+            self._cache.update(loaded)
+        return {**found, **loaded}
+
+    @classmethod
+    def uncache(cls, uid):
+        """Clear the cached items of a uid, when its profile changes
+
+        Args:
+          uid (str): User ID
+        """
+        if cls._cache is not None:
+            with cls._lock:
+                cls._cache.pop(uid, None)
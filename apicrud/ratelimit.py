@@ -4,16 +4,72 @@ created 31-dec-2020 by richb@instantlinux.net
 """
 
 from base64 import b64encode
+from cachetools import LRUCache
 from flask import g, request
 import hashlib
 import logging
-from redis.exceptions import ConnectionError
+import math
+import threading
 import time
 
 from . import state
 from .grants import Grants
+from .redis_pool import call_script
 from .service_config import ServiceConfig
 
+# Generic cell rate algorithm: the key holds the theoretical arrival
+#  time (TAT) of the next call, in seconds from redis server clock
+#  KEYS[1]: rate key; ARGV: limit, interval
+#  Returns: {allowed, remaining, reset seconds, retry-after seconds}
+GCRA_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local increment = interval / limit
+local tat = tonumber(redis.call('GET', KEYS[1]))
+if not tat or tat < now then
+  tat = now
+end
+local new_tat = tat + increment
+local allow_at = new_tat - interval
+if allow_at > now then
+  return {0, 0, tostring(tat - now), tostring(allow_at - now)}
+end
+redis.call('SET', KEYS[1], tostring(new_tat), 'PX',
+           math.ceil((new_tat - now) * 1000))
+return {1, math.floor((now + interval - new_tat) / increment),
+        tostring(new_tat - now), '0'}
+"""
+
+# Sliding-window log: a sorted set of call timestamps (milliseconds)
+#  KEYS[1]: rate key; ARGV: limit, interval
+#  Returns: {allowed, remaining, reset seconds, retry-after seconds}
+SLIDING_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2]) * 1000
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - interval)
+local count = redis.call('ZCARD', KEYS[1])
+local allowed = 0
+if count < limit then
+  redis.call('ZADD', KEYS[1], now, now .. '-' .. count)
+  redis.call('PEXPIRE', KEYS[1], interval)
+  count = count + 1
+  allowed = 1
+end
+local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+local reset = (tonumber(oldest[2]) + interval - now) / 1000
+local retry = '0'
+if allowed == 0 then
+  retry = tostring(reset)
+end
+return {allowed, limit - count, tostring(reset), retry}
+"""
+
+SCRIPTS = dict(gcra=GCRA_SCRIPT, sliding=SLIDING_SCRIPT)
+
 
 class RateLimit(object):
     """Rate Limiting
@@ -21,21 +77,29 @@ class RateLimit(object):
     Args:
       enable (bool): enable limits [default: config.RATELIMIT_ENABLE]
       interval (int): seconds to count limit [config.RATELIMIT_INTERVAL]
+      algorithm (str): gcra or sliding [config.RATELIMIT_ALGORITHM]
+
+    Attributes:
+      limit (int): limit applied by the most recent call
+      remaining (int): calls remaining within the interval
+      reset_after (float): seconds until the full limit is available again
+      retry_after (float): seconds until the next call will be allowed
     """
-    def __init__(self, enable=False, interval=None):
+    def __init__(self, enable=False, interval=None, algorithm=None):
         self.config = ServiceConfig().config
         self.enable = enable or self.config.RATELIMIT_ENABLE
         self.interval = interval or self.config.RATELIMIT_INTERVAL
+        self.algorithm = algorithm or self.config.RATELIMIT_ALGORITHM
         self.redis = state.redis_conn
+        self.limit = self.remaining = None
+        self.reset_after = self.retry_after = 0
 
     def call(self, limit=None, service='*', uid=None):
         """Apply the granted rate limit for uid to a given service
-        Two redis keys are used, for even and odd intervals as measured
-        modulo the Unix epoch time. The current interval's key is
-        incremented if we haven't reached the limit yet, then we delete
-        that key at first call seen next interval and increment the other
-        key. The keys expire within interval-1 seconds to keep the cache clear
-        after the user stops sending calls.
+        The check and count are a single server-side script invocation,
+        using either the generic cell rate algorithm (a token bucket
+        which refills at limit/interval) or a sliding-window log of
+        call timestamps. Keys expire once the user stops sending calls.
 
         Args:
           limit (int): limit for interval [default: from Grants]
@@ -52,28 +116,41 @@ class RateLimit(object):
             # No limit on anonymous requests, TODO make this smarter to
             #  protect against brute-force DDOS / security attacks
             return False
-        limit = limit or Grants().get('ratelimit', uid=uid)
-        curr = round(time.time()) % (self.interval * 2) // self.interval
-        key = 'rate:%s:%s:%d' % (service, uid, curr)
-        altkey = 'rate:%s:%s:%d' % (service, uid, 0 if curr else 1)
+        self.limit = limit or Grants().get('ratelimit', uid=uid)
+        if not self.limit:
+            return False
         try:
-            calls = self.redis.get(key)
-        except ConnectionError as ex:
+            allowed, remaining, reset, retry_after = call_script(
+                self.redis, SCRIPTS[self.algorithm],
+                keys=[self._key(service, uid)],
+                args=[self.limit, self.interval])
+        except Exception as ex:
             logging.error(dict(action='ratelimit.call', message=str(ex)))
             return False
-        if limit and not calls or int(calls.decode()) < limit:
-            try:
-                pipe = self.redis.pipeline()
-                pipe.incr(key).expire(
-                    key, self.interval - 1).delete(altkey).execute()
-            except Exception as ex:
-                logging.error(dict(action='ratelimit.call', message=str(ex)))
-        else:
+        self.remaining = int(remaining)
+        self.reset_after = float(reset)
+        self.retry_after = float(retry_after)
+        if not allowed:
             logging.info(dict(action='ratelimit.call', uid=uid,
                               service=service, message='limit exceeded'))
             return True
         return False
 
+    def headers(self):
+        """Response headers describing the most recent call
+
+        Returns:
+          dict: X-RateLimit-* and (if exceeded) Retry-After values
+        """
+        if self.limit is None or self.remaining is None:
+            return {}
+        ret = {'X-RateLimit-Limit': str(self.limit),
+               'X-RateLimit-Remaining': str(self.remaining),
+               'X-RateLimit-Reset': str(math.ceil(self.reset_after))}
+        if self.retry_after:
+            ret['Retry-After'] = str(math.ceil(self.retry_after))
+        return ret
+
     def reset(self, service='*', uid=None):
         """Clear the current entry for a service
 
@@ -81,8 +158,11 @@ class RateLimit(object):
           service (str): name of a service
           uid (str): a user ID
         """
-        self.redis.delete('rate:%s:%s:0' % (service, uid))
-        self.redis.delete('rate:%s:%s:1' % (service, uid))
+        self.redis.delete(*[self._key(service, uid, algorithm=algorithm)
+                            for algorithm in SCRIPTS])
+
+    def _key(self, service, uid, algorithm=None):
+        return 'rate:%s:%s:%s' % (service, uid, algorithm or self.algorithm)
 
     def _get_request_uid(self):
         """Examine headers to find uid
@@ -99,3 +179,92 @@ class RateLimit(object):
             return g.session.get(None, secret, key_id=prefix, arg='sub')
         elif request.authorization:
             return request.authorization.username
+
+
+class ClientLimit(object):
+    """In-process token bucket per client address, checked ahead of any
+    database work so that floods of anonymous or brute-force requests
+    are shed cheaply. Buckets are kept in an LRU cache of bounded size;
+    an evicted address simply starts over with a full bucket.
+
+    Only login calls and calls without credentials are counted; calls
+    which present credentials are governed by RateLimit, and health and
+    metrics probes are exempt. The client address is taken from
+    X-Forwarded-For as set by config.TRUSTED_PROXY_HOPS proxies.
+
+    Args:
+      rate (float): tokens refilled per second [config.RATELIMIT_CLIENT_RATE]
+      burst (int): bucket capacity [config.RATELIMIT_CLIENT_BURST]
+
+    Attributes:
+      retry_after (float): seconds until the next call will be allowed
+    """
+    _buckets = None
+    _lock = threading.Lock()
+    exempt = ('health', 'metrics')
+    login_resources = ('account_password', 'auth', 'auth_callback',
+                       'auth_totp')
+
+    def __init__(self, rate=None, burst=None):
+        self.config = config = ServiceConfig().config
+        self.enable = config.RATELIMIT_ENABLE
+        self.rate = rate or config.RATELIMIT_CLIENT_RATE
+        self.burst = burst or config.RATELIMIT_CLIENT_BURST
+        self.retry_after = 0
+        with self._lock:
+            if ClientLimit._buckets is None:
+                ClientLimit._buckets = LRUCache(
+                    maxsize=config.RATELIMIT_CLIENT_MAX)
+
+    def call(self, address=None):
+        """Take a token from the client's bucket
+
+        Args:
+          address (str): client IP address [default: request.remote_addr]
+
+        Returns:
+          bool: true if limit exceeded
+        """
+        if not self.enable or not self.burst:
+            return False
+        address = address or request.remote_addr
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(address, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._buckets[address] = (tokens, now)
+                self.retry_after = (1 - tokens) / self.rate
+            else:
+                self._buckets[address] = (tokens - 1, now)
+        if self.retry_after:
+            logging.info(dict(action='clientlimit.call', address=address,
+                              message='limit exceeded'))
+            return True
+        return False
+
+    def applies(self, resource=None):
+        """Whether the current request is subject to the client limit
+
+        Args:
+          resource (str): resource name of the request
+
+        Returns:
+          bool: true for login calls, and others without credentials;
+            decided from request headers alone
+        """
+        if resource in self.exempt:
+            return False
+        return resource in self.login_resources or not (
+            request.authorization or
+            self.config.HEADER_AUTH_APIKEY in request.headers)
+
+    def headers(self):
+        """Response headers
+
+        Returns:
+          dict: Retry-After value if limit exceeded
+        """
+        if self.retry_after:
+            return {'Retry-After': str(math.ceil(self.retry_after))}
+        return {}
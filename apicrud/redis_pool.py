@@ -0,0 +1,125 @@
+"""redis_pool.py
+
+Shared redis connection pool
+"""
+
+import logging
+import os
+import redis
+import threading
+import time
+
+from .service_config import ServiceConfig
+
+_lock = threading.Lock()
+_pools = {}
+_scripts = {}
+
+
+def redis_connect(host=None):
+    """Get a redis client which draws from this process's connection
+    pool for the given host; pools are rebuilt after a fork so that
+    workers never share sockets with the parent. When the pool is
+    exhausted, callers wait up to redis_pool_timeout seconds for a
+    free connection. Settings are taken from redis_xxx in service
+    config.
+
+    Args:
+      host (str): hostname [default: config.REDIS_HOST], ignored if
+        redis_unix_socket is set
+
+    Returns:
+      obj: redis client
+    """
+    config = ServiceConfig().config
+    key = (os.getpid(), host or config.REDIS_HOST)
+    if key not in _pools:
+        params = dict(
+            db=0, max_connections=config.REDIS_MAX_CONNECTIONS,
+            timeout=config.REDIS_POOL_TIMEOUT,
+            health_check_interval=config.REDIS_HEALTH_CHECK_INTERVAL,
+            socket_timeout=config.REDIS_SOCKET_TIMEOUT)
+        if config.REDIS_UNIX_SOCKET:
+            params.update(connection_class=redis.UnixDomainSocketConnection,
+                          path=config.REDIS_UNIX_SOCKET)
+        else:
+            params.update(
+                host=key[1], port=config.REDIS_PORT,
+                socket_connect_timeout=config.REDIS_SOCKET_CONNECT_TIMEOUT)
+        with _lock:
+            if key not in _pools:
+                _pools[key] = redis.BlockingConnectionPool(**params)
+    return redis.Redis(connection_pool=_pools[key])
+
+
+def call_script(connection, script, keys=[], args=[]):
+    """Run a Lua script by its SHA1 digest; the script object is
+    registered once per process rather than on each call, and redis-py
+    loads it again if the server doesn't have it cached
+
+    Args:
+      connection (obj): redis client or pipeline
+      script (str): Lua source
+      keys (list): key names
+      args (list): arguments
+
+    Returns:
+      obj: the script's return value
+    """
+    registered = _scripts.get(script)
+    if not registered:
+        registered = _scripts.setdefault(
+            script, connection.register_script(script))
+    return registered(keys=keys, args=args, client=connection)
+
+
+def subscribe(connection, channel, handler, reset=None):
+    """Start a daemon thread which passes each message published on
+    a channel to a handler. If the subscriber loses its connection,
+    the thread calls reset (since messages may have been missed) and
+    keeps retrying; the channel is resubscribed upon reconnect.
+
+    Args:
+      connection (obj): redis client
+      channel (str): channel name
+      handler (function): called with each message
+      reset (function): called after a connection error
+
+    Returns:
+      obj: the subscriber thread, or None if redis is unreachable
+    """
+    def _reconnect(ex, pubsub, thread):
+        logging.warning(dict(action='redis.subscribe', channel=channel,
+                             message=str(ex)))
+        if reset:
+            reset()
+        time.sleep(1)
+
+    try:
+        pubsub = connection.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{channel: handler})
+    except redis.exceptions.ConnectionError as ex:
+        logging.warning(dict(action='redis.subscribe', channel=channel,
+                             message=str(ex)))
+        return None
+    return pubsub.run_in_thread(sleep_time=1, daemon=True,
+                                exception_handler=_reconnect)
+
+
+def pool_stats(connection):
+    """Connection counts of a redis client's pool; these are read
+    from attributes which aren't part of the redis-py API, so any
+    missing from the installed version are reported as zero
+
+    Args:
+      connection (obj): redis client
+
+    Returns:
+      dict: created, in_use, available and max connections
+    """
+    pool = connection.connection_pool
+    created = len(getattr(pool, '_connections', ()))
+    available = len([conn for conn in getattr(
+        getattr(pool, 'pool', None), 'queue', ()) if conn])
+    return dict(available=available, created=created,
+                in_use=created - available, max=pool.max_connections)
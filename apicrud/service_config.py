@@ -166,22 +166,28 @@ class ServiceConfig(object):
 
     @staticmethod
     def _compose_metrics(metrics):
-        """Fill in default values for scope, style, period
+        """Fill in default values for scope, style, period, buckets
 
         Args:
             metrics (dict): usage metric definitions
                 period: hour, day, week, month, indefinite
                 scope: user, instance, sitewide
-                style: grant, usage
+                style: grant, counter, gauge, histogram, summary
+                buckets: upper bounds for histogram
         """
         ret = metrics
         for key, item in metrics.items():
-            if set(item.keys()) - set(['notify', 'period', 'scope', 'style']):
+            if set(item.keys()) - set(['buckets', 'help', 'notify', 'period',
+                                       'scope', 'style']):
                 raise AttributeError('Invalid metric configuration')
             ret[key]['notify'] = item.get('notify', 0)
             ret[key]['period'] = item.get('period', 'day')
             ret[key]['scope'] = item.get('scope', 'user')
             ret[key]['style'] = item.get('style', 'grant')
+            if ret[key]['style'] == 'histogram':
+                ret[key]['buckets'] = sorted(
+                    float(bound) for bound in item.get(
+                        'buckets', Constants.HISTOGRAM_BUCKETS))
         return ret
 
     @staticmethod
@@ -9,7 +9,6 @@ import logging
 import os
 from sqlalchemy.exc import DataError, IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
-import time
 
 from . import state
 from .access import AccessControl
@@ -68,14 +67,14 @@ class SessionAuth(object):
         logmsg = dict(action='login', username=username, method=method)
         acc = AccessControl()
         content, status, headers = _(u'access denied'), 403, []
-        if RateLimit(enable=True,
-                     interval=self.config.LOGIN_LOCKOUT_INTERVAL).call(
-                         limit=self.config.LOGIN_ATTEMPTS_MAX,
-                         service='login.attempt', uid=username):
-            time.sleep(5)
+        ratelimit = RateLimit(enable=True,
+                              interval=self.config.LOGIN_LOCKOUT_INTERVAL)
+        if ratelimit.call(limit=self.config.LOGIN_ATTEMPTS_MAX,
+                          service='login.attempt', uid=username):
             msg = _(u'locked out')
             logging.warning(dict(message=msg, **logmsg))
-            return dict(username=username, message=msg), 403
+            return dict(username=username, message=msg), 403, [
+                ('Retry-After', ratelimit.headers().get('Retry-After'))]
         if acc.auth and ('pendingtotp' in acc.auth or (otp and acc.apikey_id)):
             # TODO make this pendingtotp finite-state logic more robust
             if otp:
@@ -3,18 +3,21 @@
 created 8-may-2019 by richb@instantlinux.net
 """
 
+from cachetools import TTLCache
 from datetime import datetime, timedelta
+from flask import g, has_app_context
 import json
 import logging
 import redis
+import threading
 import time
 
+from . import state
 from .aes_encrypt import AESEncrypt
+from .redis_pool import redis_connect, subscribe
 from .service_config import ServiceConfig
 from .utils import gen_id
 
-saved_redis = None
-
 
 class SessionManager(object):
     """Session Manager - for active user sessions
@@ -22,21 +25,27 @@ class SessionManager(object):
     Each login session is stored as an encrypted JSON dict in redis, indexed
     by sub:token
 
+    If session_cache_size is set, decrypted sessions are also held
+    for a few seconds in a local cache; a subscriber thread evicts
+    entries when any worker publishes an update or delete.
+
     Args:
       ttl (int): seconds until a session expires
       redis_conn (obj): connection to redis service
     """
-    def __init__(self, ttl=None, redis_conn=None):
-        global saved_redis
+    _cache = None
+    _lock = threading.Lock()
+    _thread = None
+    channel = 'ses:invalidate'
 
+    def __init__(self, ttl=None, redis_conn=None):
         self.config = ServiceConfig().config
-        self.connection = (
-            redis_conn or saved_redis or redis.Redis(
-                host=self.config.REDIS_HOST,
-                port=self.config.REDIS_PORT, db=0))
-        saved_redis = self.connection
+        self.connection = redis_conn or state.redis_conn or redis_connect()
         self.ttl = ttl or self.config.REDIS_TTL
         self.aes = AESEncrypt(self.config.REDIS_AES_SECRET)
+        if self.config.SESSION_CACHE_SIZE and not (
+                SessionManager._thread and SessionManager._thread.is_alive()):
+            self._subscribe()
 
     def create(self, uid, roles, key_id=None, **kwargs):
         """Create a session, which is an encrypted JSON object with the values
@@ -80,6 +89,7 @@ class SessionManager(object):
         )
         key = 'ses:%s:%s' % (key_id or uid, token[-3:])
         content = {**params, **kwargs}  # noqa
+        _reset_context()
         try:
             if self.connection.set(key, self.aes.encrypt(json.dumps(
                     content)), ex=ttl, nx=True):
@@ -100,15 +110,26 @@ class SessionManager(object):
           dict or str: single value or dictionary of all session keys
         """
         key = 'ses:%s:%s' % (key_id or uid, token[-3:])
-        try:
-            data = json.loads(self.aes.decrypt(
-                self.connection.get(key)))
-        except TypeError:
-            return None
-        except Exception as ex:
-            logging.info(dict(action='session.get', uid=uid,
-                              exception=str(ex)))
-            return None
+        cache = self._cache if self.config.SESSION_CACHE_SIZE else None
+        data = None
+        if cache is not None:
+            with self._lock:
+                data = cache.get(key)
+        if data:
+            data = dict(data)
+        else:
+            try:
+                data = json.loads(self.aes.decrypt(
+                    self.connection.get(key)))
+            except TypeError:
+                return None
+            except Exception as ex:
+                logging.info(dict(action='session.get', uid=uid,
+                                  exception=str(ex)))
+                return None
+            if cache is not None:
+                with self._lock:
+                    cache[key] = dict(data)
         if data['jti'] != token:
             logging.warning(dict(action='session.get', message='rejected'))
             return None
@@ -129,10 +150,12 @@ class SessionManager(object):
           TypeError if uid/token not found in redis
         """
         key = 'ses:%s:%s' % (key_id or uid, token[-3:])
-        data = self.get(uid, token)
+        data = dict(self.get(uid, token, key_id=key_id))
         data[arg] = value
+        _reset_context()
         self.connection.set(key, self.aes.encrypt(
             json.dumps(data)), ex=self.ttl)
+        self._invalidate(key)
 
     def delete(self, uid, token, key_id=None):
         """Cancel a session
@@ -142,11 +165,60 @@ class SessionManager(object):
           token (str): The token value passed from create as 'jti'
           key_id (str): session key ID for redis
         """
+        _reset_context()
+        key = 'ses:%s:%s' % (key_id or uid, token[-3:])
         try:
-            self.connection.delete('ses:%s:%s' % (key_id or uid, token[-3:]))
+            self.connection.delete(key)
+            self._invalidate(key)
         except redis.exceptions.ConnectionError as ex:
             logging.error(dict(action='session.delete', message=str(ex)))
 
+    def _invalidate(self, key):
+        """Evict a session from the local cache, and notify other workers
+
+        Args:
+          key (str): redis key of the session
+        """
+        if not self.config.SESSION_CACHE_SIZE:
+            return
+        if SessionManager._cache is not None:
+            with self._lock:
+                SessionManager._cache.pop(key, None)
+        self.connection.publish(self.channel, key)
+
+    def _subscribe(self):
+        """Create the local cache, and start a thread which evicts
+        entries published by other workers. The cache is only used
+        while the thread is running; startup is retried on a later
+        call if redis is unreachable, or in a forked child.
+        """
+        def _evict(message):
+            key = message['data']
+            with SessionManager._lock:
+                SessionManager._cache.pop(
+                    key.decode() if isinstance(key, bytes) else key, None)
+
+        def _reset():
+            with SessionManager._lock:
+                SessionManager._cache.clear()
+
+        with SessionManager._lock:
+            if SessionManager._thread and SessionManager._thread.is_alive():
+                return
+            SessionManager._cache = None
+            SessionManager._thread = subscribe(
+                self.connection, self.channel, _evict, reset=_reset)
+            if SessionManager._thread:
+                SessionManager._cache = TTLCache(
+                    maxsize=self.config.SESSION_CACHE_SIZE,
+                    ttl=self.config.SESSION_CACHE_TTL)
+
+
+def _reset_context():
+    """Discard sessions memoized by AccessControl for the current request"""
+    if has_app_context():
+        g.pop('access_contexts', None)
+
 
 class Mutex:
     """Simple mutex implementation for non-clustered Redis
@@ -161,9 +233,7 @@ class Mutex:
     def __init__(self, lockname, redis_host=None, maxwait=20,
                  ttl=0, redis_conn=None):
         config = ServiceConfig().config
-        self.connection = (
-            redis_conn or redis.Redis(host=redis_host,
-                                      port=config.REDIS_PORT, db=0))
+        self.connection = redis_conn or redis_connect(host=redis_host)
         self.ttl = ttl or config.REDIS_TTL
         self.lock_signature = gen_id()
         self.lockname = lockname
@@ -129,26 +129,25 @@ class Trashcan(BasicCRUD):
                       ident=AccessControl().identity)
         errors = 0
         count = 0
+        resources = {}
         for id in ids:
             resource, record_id = id.split('-', maxsplit=1)
+            resources.setdefault(resource, []).append(record_id)
+        for resource, record_ids in resources.items():
             if resource == 'apikey':
                 model = self.models.APIkey
             else:
                 model = getattr(self.models, resource.capitalize())
             try:
-                query = g.db.query(model).filter_by(id=record_id)
-                if not AccessControl(
-                        model=model).with_permission(
-                            'd', query=query):
-                    return dict(message=_(u'access denied'), id=id), 403
-                if query.delete():
-                    logging.info(dict(id=id, **logmsg))
-                else:
-                    logging.info(dict(id=id, msg='query failed', **logmsg))
-                    errors += 1
+                denied, missing = self._delete_set(
+                    model, record_ids, force=True)
             except Exception as ex:
                 return db_abort(str(ex), **logmsg)
-            count += 1
+            if denied:
+                return dict(message=_(u'access denied'),
+                            id='%s-%s' % (resource, denied)), 403
+            errors += missing
+            count += len(record_ids)
         try:
             g.db.commit()
         except Exception as ex:
@@ -271,15 +270,10 @@ class Trashcan(BasicCRUD):
                 results = query.slice(offset, offset + limit + 1).all()
             except Exception as ex:
                 return db_abort(str(ex), **logmsg)
-            for result in results[:limit - retval['count'] + 1]:
-                if retval['count'] >= limit:
-                    retval['cursor_next'] = self._tob64(
-                        'cursor:%s:%d' % (resource, offset))
-                    logging.info(dict(
-                        offset=offset, duration=utils.req_duration(),
-                        **logmsg))
-                    return retval, 200
-                data = result.as_dict()
+            results = [result.as_dict()
+                       for result in results[:limit - retval['count'] + 1]]
+            page = results[:limit - retval['count']]
+            for data, rbac in zip(page, acc.rbac_permissions_bulk(page)):
                 # Compose a limited amount of descriptive metadata
                 record = {
                     key: data[key] for key in (
@@ -292,11 +286,17 @@ class Trashcan(BasicCRUD):
                     if hasattr(model, col):
                         record['name'] = data[col]
                         break
-                # TODO check for delete permission
-                record['rbac'] = 'dru'
+                # Deleted items can only be read, restored or purged
+                record['rbac'] = ''.join(sorted(set(rbac) & set('dru')))
                 retval['items'].append(record)
                 retval['count'] += 1
                 offset += 1
+            if len(results) > len(page):
+                retval['cursor_next'] = self._tob64(
+                    'cursor:%s:%d' % (resource, offset))
+                logging.info(dict(
+                    offset=offset, duration=utils.req_duration(), **logmsg))
+                return retval, 200
             if retval['items']:
                 offset = 0
         logging.info(dict(
@@ -14,8 +14,6 @@ from apicrud.messaging.send import Messaging
 import celeryconfig
 from example import models
 
-# TODO add function to send to a recipients list
-
 app = celery.Celery()
 app.config_from_object(celeryconfig)
 
@@ -35,6 +33,23 @@ def send_contact(frm=None, to=None, to_uid=None, template=None, **kwargs):
         frm=frm, to=to, to_uid=to_uid, template=template, **kwargs)
 
 
+@app.task(name='tasks.messaging.send_bulk')
+def send_bulk(frm=None, recipients=None, to_uids=None, template=None,
+              **kwargs):
+    """
+    Args:
+      frm (uid): person
+      recipients (list): IDs of Contact records
+      to_uids (list): uids of people, to reach at primary contact
+      template (str): jinja2 template name
+      kwargs: kv pairs
+    Raises:
+      SendException
+    """
+    Messaging().send_bulk(recipients, template, frm=frm, to_uids=to_uids,
+                          **kwargs)
+
+
 initialize.worker(models=models,
                   path=os.path.dirname(os.path.abspath(__file__)),
                   func_send=send_contact.delay)
@@ -0,0 +1,84 @@
+"""test_access
+
+Tests for role-based access control
+"""
+from flask import g, request
+from unittest import mock
+
+import test_base
+from apicrud import AccessControl, database, SessionManager
+from example import models
+
+
+class TestAccess(test_base.TestBase):
+
+    def setUp(self):
+        self.authorize()
+
+    def _access(self, model):
+        g.db = database.get_session()
+        g.session = SessionManager(redis_conn=self.redis)
+        return AccessControl(model=model)
+
+    def test_rbac_compiled_policies(self):
+        with self.app.test_request_context(headers=dict(
+                Authorization=self.credentials[self.username]['auth'])):
+            acc = self._access(models.Contact)
+            self.assertEqual(acc.rbac_permissions(owner_uid=self.test_uid),
+                             set('cdru'))
+            self.assertEqual(acc.rbac_permissions(
+                owner_uid=self.admin_uid, privacy='public'), set('r'))
+            self.assertEqual(acc.rbac_permissions(
+                owner_uid=self.admin_uid, privacy='secret'), set())
+            g.db.remove()
+
+    def test_rbac_memoized_per_tuple(self):
+        with self.app.test_request_context(headers=dict(
+                Authorization=self.credentials[self.username]['auth'])):
+            acc = self._access(models.Contact)
+            for id in ('x-1', 'x-2', 'x-3'):
+                self.assertEqual(acc.rbac_permissions(
+                    owner_uid=self.test_uid, membership='list', id=id,
+                    privacy='member'), set('cdru'))
+            self.assertEqual(len(acc._rbac_cache), 1)
+            acc.rbac_permissions(owner_uid=self.admin_uid, membership='list',
+                                 id='x-4', privacy='member')
+            self.assertEqual(len(acc._rbac_cache), 2)
+            g.db.remove()
+
+    def test_rbac_permissions_bulk(self):
+        with self.app.test_request_context(headers=dict(
+                Authorization=self.credentials[self.username]['auth'])):
+            acc = self._access(models.Contact)
+            identity = g.db.query(models.Person).filter_by(
+                id=self.test_uid).one().identity
+            records = [item.as_dict() for item in g.db.query(
+                models.Contact).filter_by(uid=self.test_uid).all()]
+            rbacs = acc.rbac_permissions_bulk(records)
+            self.assertEqual(len(rbacs), len(records))
+            for record, rbac in zip(records, rbacs):
+                self.assertEqual(rbac, 'ru' if record['info'] == identity
+                                 else 'dru')
+            g.db.remove()
+
+    def test_session_decoded_once_per_request(self):
+        with self.app.test_request_context(headers=dict(
+                Authorization=self.credentials[self.username]['auth'])):
+            g.session = SessionManager(redis_conn=self.redis)
+            creds = request.authorization
+            with mock.patch.object(g.session, 'get',
+                                   wraps=g.session.get) as mock_get:
+                for i in range(3):
+                    acc = AccessControl(model=models.Contact)
+                    self.assertEqual(acc.uid, self.test_uid)
+                    self.assertEqual(acc.identity, self.test_email)
+                self.assertEqual(mock_get.call_count, 1)
+
+            # A session update is seen by subsequent lookups
+            roles = acc.auth
+            g.session.update(creds.username, creds.password, 'auth',
+                             ':'.join(roles + ['list-x-12345678-member']))
+            acc = AccessControl(model=models.Contact)
+            self.assertIn('x-12345678', acc.auth_ids['list'])
+            g.session.update(creds.username, creds.password, 'auth',
+                             ':'.join(roles))
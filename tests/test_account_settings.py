@@ -0,0 +1,66 @@
+"""test_account_settings
+
+Tests for cached account settings
+"""
+
+from sqlalchemy import event
+
+import test_base
+from apicrud import AccountSettings, database
+
+
+class TestAccountSettings(test_base.TestBase):
+
+    def _count_queries(self, db_session):
+        queries = []
+        engine = db_session.get_bind()
+
+        def _count(conn, cursor, statement, *args):
+            queries.append(statement)
+
+        event.listen(engine, 'before_cursor_execute', _count)
+        self.addCleanup(event.remove, engine, 'before_cursor_execute', _count)
+        return queries
+
+    def test_settings_loaded_once(self):
+        db_session = database.get_session()
+        AccountSettings(self.account_id, db_session=db_session).uncache()
+        queries = self._count_queries(db_session)
+        settings = AccountSettings(self.account_id, db_session=db_session)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(settings.uid, self.test_uid)
+        self.assertEqual(settings.get.category_id, self.cat_id)
+        self.assertEqual(settings.get.id, self.settings_id)
+        self.assertIsInstance(settings.get.approved_senders, frozenset)
+        with self.assertRaises(AttributeError):
+            settings.get.url = 'https://example.com'
+        self.assertFalse(hasattr(settings.get, '__dict__'))
+
+        # Hits by account_id or uid don't query the database
+        AccountSettings(self.account_id, db_session=db_session)
+        self.assertEqual(AccountSettings(
+            None, db_session=db_session, uid=self.test_uid).account_id,
+            self.account_id)
+        self.assertEqual(len(queries), 1)
+        db_session.remove()
+
+    def test_locale_invalidated_by_profile(self):
+        self.authorize()
+        db_session = database.get_session()
+        settings = AccountSettings(self.account_id, db_session=db_session)
+        self.assertIsNone(settings.locale)
+        queries = self._count_queries(db_session)
+        self.assertIsNone(settings.locale)
+        self.assertEqual(len(queries), 0)
+
+        response = self.call_endpoint('/profile', 'post', data=dict(
+            item='lang', value='fr_FR', uid=self.test_uid))
+        self.assertEqual(response.status_code, 201)
+        id = response.get_json()['id']
+        self.assertEqual(settings.locale, 'fr_FR')
+
+        response = self.call_endpoint('/profile/%s?force=true' % id,
+                                      'delete')
+        self.assertEqual(response.status_code, 204)
+        self.assertIsNone(settings.locale)
+        db_session.remove()
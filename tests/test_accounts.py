@@ -6,6 +6,8 @@ created 4-nov-2019 by richb@instantlinux.net
 """
 
 import pytest
+import threading
+import time
 from unittest import mock
 
 from apicrud import database
@@ -284,21 +286,33 @@ class TestAccounts(test_base.TestBase):
                          response.get_json().get('message'))
 
     @pytest.mark.slow
-    @mock.patch('time.sleep')
-    def test_account_lockout(self, mock_sleep):
+    def test_account_lockout(self):
         username = 'brute'
-        with self.scratch_account(username, 'Brute Force') as acc:
+        sleeps = []
+        real_sleep = time.sleep
+
+        def _sleep(secs):
+            # Background subscriber threads poll with short sleeps
+            if threading.current_thread() is threading.main_thread():
+                sleeps.append(secs)
+            else:
+                real_sleep(secs)
+
+        with self.scratch_account(username, 'Brute Force') as acc, \
+                mock.patch('time.sleep', side_effect=_sleep):
             for i in range(self.config.LOGIN_ATTEMPTS_MAX):
                 status = self.authorize(username=username,
                                         password='Disa1lowed',
                                         new_session=True)
                 self.assertEqual(status, 403)
 
-            status = self.authorize(username=username,
-                                    password=acc.password,
-                                    new_session=True)
-            self.assertEqual(status, 403)
-            mock_sleep.assert_has_calls([mock.call(5)])
+            response = self.call_endpoint('/auth', 'post', data=dict(
+                username=username, password=acc.password))
+            self.assertEqual(response.status_code, 403)
+            self.assertEqual(response.get_json()['message'], 'locked out')
+            self.assertLessEqual(int(response.headers['Retry-After']),
+                                 self.config.LOGIN_LOCKOUT_INTERVAL)
+            self.assertEqual(sleeps, [])
 
     @pytest.mark.slow
     def test_account_disabled(self):
@@ -145,6 +145,64 @@ class TestContacts(test_base.TestBase):
                 message=u'user limit exceeded', allowed=max_contacts))
             self.mock_messaging.assert_has_calls(calls)
 
+    def test_create_contacts_bulk(self):
+        max_contacts = self.config.DEFAULT_GRANTS.get('contacts')
+        contact = dict(label='home', type='email', privacy='invitee')
+
+        with self.scratch_account('mlopez', 'Morgan Lopez') as acc:
+            response = self.call_endpoint('/contact/bulk', 'post', data=[
+                dict(info='bulk1@conclave.events', **contact),
+                dict(info='not-an-address', **contact),
+                dict(info='bulk3@conclave.events', extraneous=1, **contact),
+                dict(info='bulk2@conclave.events', uid=acc.uid, **contact)])
+            self.assertEqual(response.status_code, 201)
+            result = response.get_json()
+            self.assertEqual(result['count'], 2)
+            self.assertEqual([item['status'] for item in result['items']],
+                             [201, 405, 405, 201])
+            self.assertEqual(result['items'][1]['message'],
+                             'invalid email address')
+
+            # Each created contact is sent a confirmation
+            for item in (result['items'][0], result['items'][3]):
+                self.assertIn('token', item)
+                self.mock_messaging.assert_any_call(
+                    to=item['id'], template='contact_add',
+                    token=item['token'], type='email')
+
+            # Rejected items don't leave gaps in rank
+            response = self.call_endpoint('/contact/%s' % result['items'][3][
+                'id'], 'get')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json()['info'],
+                             'bulk2@conclave.events')
+            self.assertEqual(response.get_json()['rank'], 3)
+
+            # The grant limit is checked against the whole batch
+            response = self.call_endpoint('/contact/bulk', 'post', data=[
+                dict(info='more%d@conclave.events' % i, **contact)
+                for i in range(max_contacts - 2)])
+            self.assertEqual(response.status_code, 405)
+            self.assertEqual(response.get_json(), dict(
+                message=u'user limit exceeded', allowed=max_contacts))
+            response = self.call_endpoint('/contact/bulk', 'post', data=[
+                dict(info='other@conclave.events', uid=self.admin_uid,
+                     **contact)])
+            self.assertEqual(response.status_code, 405)
+            self.assertEqual(response.get_json()['items'][0]['status'], 403)
+
+            # A conflict on insert creates none of the batch
+            response = self.call_endpoint('/contact/bulk', 'post', data=[
+                dict(info='bulk4@conclave.events', **contact),
+                dict(info='bulk1@conclave.events', **contact)])
+            self.assertEqual(response.status_code, 405)
+            self.assertEqual(response.get_json(), dict(
+                message='duplicate or other conflict, no items were created',
+                count=0))
+            response = self.call_endpoint(
+                '/contact?filter={"info":"bulk4@conclave.events"}', 'get')
+            self.assertEqual(response.get_json()['items'], [])
+
     def test_get_contact_restricted(self):
         """Attempt to fetch private contact from an unprivileged user
         """
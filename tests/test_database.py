@@ -0,0 +1,49 @@
+"""test_database
+
+Tests for database session and pool management
+"""
+
+from sqlalchemy import create_engine
+import threading
+from unittest import mock
+
+import test_base
+from apicrud import database, Metrics
+
+
+class TestDatabase(test_base.TestBase):
+
+    def test_session_factory_reused(self):
+        session = database.get_session()
+        self.assertIs(database.get_session(), session)
+        factory = database.get_session(scoped=False)
+        self.assertIsNot(factory, session)
+        registries = len(database.sessions)
+        self.assertIs(database.get_session(scoped=False), factory)
+        self.assertEqual(len(database.sessions), registries)
+
+        # Each scope function gets its own registry
+        threaded = database.get_session(scopefunc=threading.get_ident)
+        self.assertIsNot(threaded, session)
+        self.assertIs(database.get_session(scopefunc=threading.get_ident),
+                      threaded)
+        self.assertEqual(len(database.sessions), registries + 1)
+
+    def test_pool_metrics(self):
+        engine = create_engine(
+            'sqlite://', poolclass=database.TimedQueuePool, pool_size=2,
+            max_overflow=1)
+        database.listen(engine, 'connect', database._record_connect)
+        database.listen(engine, 'checkout', database._record_checkout)
+        with mock.patch.object(Metrics, '_observations', {}):
+            conn = engine.connect()
+            self.assertEqual(database.pool_stats(engine), dict(
+                checked_out=1, overflow=0, size=2))
+            conn.close()
+            conn = engine.connect()
+            conn.close()
+            observed = {name: fields['count'] for (name, labels), fields
+                        in Metrics._observations.items()}
+        self.assertEqual(observed, dict(db_pool_connection_age_seconds=2,
+                                        db_pool_wait_seconds=2))
+        engine.dispose()
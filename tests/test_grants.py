@@ -7,6 +7,9 @@ created 8-nov-2019 by richb@instantlinux.net
 
 from datetime import datetime, timedelta
 from flask import g
+from unittest import mock
+import redis
+import time
 
 import test_base
 
@@ -183,3 +186,75 @@ class TestGrants(test_base.TestBase):
         # Clean up the grant
         response = self.call_endpoint('/grant/%s' % id, 'delete')
         self.assertEqual(response.status_code, 204)
+
+    def test_shared_cache_versions(self):
+        record = dict(name='albums', value='7', uid=self.test_uid)
+        key = 'gra:%s' % self.test_uid
+        response = self.call_endpoint('/grant', 'post', data=record)
+        self.assertEqual(response.status_code, 201)
+        id = response.get_json()['id']
+        version = int(self.redis.get('grv:%s' % self.test_uid))
+
+        with self.app.test_request_context():
+            g.db = database.get_session()
+            self.assertEqual(Grants().get('albums', uid=self.test_uid), 7)
+            self.assertEqual(self.redis.hget(key, 'albums'), b'7')
+            self.assertEqual(self.redis.hget(key, '_v'), str(
+                version).encode())
+
+            # Another worker's local miss is served from redis
+            Grants._cache.pop(self.test_uid)
+            self.redis.hset(key, 'albums', '8')
+            self.assertEqual(Grants().get('albums', uid=self.test_uid), 8)
+
+            # A copy stored under an older version stamp is discarded
+            Grants._cache.pop(self.test_uid)
+            self.redis.incr('grv:%s' % self.test_uid)
+            self.assertEqual(Grants().get('albums', uid=self.test_uid), 7)
+            g.db.remove()
+
+        response = self.call_endpoint('/grant/%s' % id, 'put', data=dict(
+            record, value='9'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(int(self.redis.get('grv:%s' % self.test_uid)),
+                         version + 2)
+        self.assertFalse(self.redis.exists(key))
+        with self.app.test_request_context():
+            g.db = database.get_session()
+            self.assertEqual(Grants().get('albums', uid=self.test_uid), 9)
+            g.db.remove()
+
+        response = self.call_endpoint('/grant/%s?force=true' % id, 'delete')
+        self.assertEqual(response.status_code, 204)
+        self.assertNotIn(self.test_uid, Grants._cache)
+
+    def test_invalidation_published(self):
+        with self.app.test_request_context():
+            g.db = database.get_session()
+            Grants().get('lists', uid=self.admin_uid)
+            g.db.remove()
+        self.assertIn(self.admin_uid, Grants._cache)
+        self.redis.publish(Grants.channel, '%s:99' % self.admin_uid)
+        for i in range(30):
+            if self.admin_uid not in Grants._cache:
+                break
+            time.sleep(0.1)
+        self.assertNotIn(self.admin_uid, Grants._cache)
+
+    def test_subscriber_restarted(self):
+        Grants()
+        with mock.patch.object(
+                redis.client.PubSub, 'subscribe',
+                side_effect=redis.exceptions.ConnectionError('down')):
+            Grants._thread.stop()
+            Grants._thread.join(timeout=5)
+            self.assertFalse(Grants._thread.is_alive())
+
+            # An unreachable redis doesn't fail the caller
+            Grants()
+            self.assertIsNone(Grants._thread)
+        with self.app.test_request_context():
+            g.db = database.get_session()
+            Grants().get('lists', uid=self.admin_uid)
+            g.db.remove()
+        self.assertTrue(Grants._thread.is_alive())
@@ -5,7 +5,12 @@ Tests for lists controller
 created 22-oct-2019 by richb@instantlinux.net
 """
 
+import base64
+from sqlalchemy import event
+from urllib.parse import quote
+
 import test_base
+from apicrud import database
 
 
 class TestLists(test_base.TestBase):
@@ -103,3 +108,154 @@ class TestLists(test_base.TestBase):
         expected.update(dict(members=set(members), id=id))
         result['members'] = set(result['members'])
         self.assertEqual(result, expected)
+
+    def test_list_replace_members(self):
+        response = self.call_endpoint('/list', 'post', data=dict(
+            name='list8', category_id=self.cat_id,
+            members=[self.test_uid, self.global_admin_id]))
+        self.assertEqual(response.status_code, 201)
+        id = response.get_json()['id']
+        for members in ([self.global_admin_id, self.admin_uid], [],
+                        [self.test_uid]):
+            response = self.call_endpoint('/list/%s' % id, 'put', data=dict(
+                name='list8', members=members))
+            self.assertEqual(response.status_code, 200)
+            response = self.call_endpoint('/list/%s' % id, 'get')
+            self.assertEqual(set(response.get_json()['members']),
+                             set(members))
+        response = self.call_endpoint('/list/%s' % id, 'put', data=dict(
+            name='list8', members=[self.test_uid, 'u-notfound']))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json()['ids'], ['u-notfound'])
+        response = self.call_endpoint('/list/%s?force=true' % id, 'delete')
+        self.assertEqual(response.status_code, 204)
+
+    def test_create_list_unknown_member(self):
+        statements = []
+
+        def _record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(database.db_engine, 'before_cursor_execute', _record)
+        try:
+            response = self.call_endpoint('/list', 'post', data=dict(
+                name='list9', category_id=self.cat_id,
+                members=[self.test_uid, 'u-notfound']))
+        finally:
+            event.remove(database.db_engine, 'before_cursor_execute',
+                         _record)
+        self.assertEqual(response.status_code, 404)
+        # Nothing is written when a member doesn't exist
+        self.assertFalse([statement for statement in statements
+                          if statement.startswith(('INSERT', 'DELETE'))])
+        self.assertEqual(response.get_json()['ids'], ['u-notfound'])
+        response = self.call_endpoint(
+            '/list?filter={"name":"list9"}', 'get')
+        self.assertEqual(response.get_json()['count'], 0)
+
+    def test_find_lists_constant_queries(self):
+        for name in ('list5', 'list6', 'list7'):
+            response = self.call_endpoint('/list', 'post', data=dict(
+                name=name, category_id=self.cat_id))
+            self.assertEqual(response.status_code, 201)
+        statements = []
+
+        def _count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(database.db_engine, 'before_cursor_execute', _count)
+        try:
+            queries = []
+            for limit in (1, 3):
+                statements.clear()
+                response = self.call_endpoint(
+                    '/list?limit=%d&filter={"name":"list%%"}' % limit, 'get')
+                self.assertEqual(response.status_code, 200)
+                items = response.get_json()['items']
+                self.assertEqual(len(items), limit)
+                for item in items:
+                    self.assertEqual(item['owner'], self.test_person_name)
+                    self.assertEqual(item['category'], 'default')
+                queries.append(len(statements))
+        finally:
+            event.remove(database.db_engine, 'before_cursor_execute', _count)
+        self.assertEqual(queries[0], queries[1])
+
+        # Eager-loaded relationships don't leak into the results
+        response = self.call_endpoint('/list/%s' % items[0]['id'], 'get')
+        self.assertEqual(set(items[0]) - set(['modified']),
+                         set(response.get_json()))
+
+    def test_find_lists_keyset_pagination(self):
+        expected = []
+        for name in ('page-a', 'page-b', 'page-c'):
+            response = self.call_endpoint('/list', 'post', data=dict(
+                name=name, category_id=self.cat_id))
+            self.assertEqual(response.status_code, 201)
+            expected.append(response.get_json()['id'])
+        for sort, ids in (('name', expected), ('name:desc', expected[::-1]),
+                          ('created', expected)):
+            cursor_next, items = (None, [])
+            while True:
+                uripath = '/list?limit=1&sort=%s&filter={"name":"page-%%"}' % (
+                    sort)
+                if cursor_next:
+                    uripath += '&cursor_next=%s' % quote(cursor_next)
+                response = self.call_endpoint(uripath, 'get')
+                self.assertEqual(response.status_code, 200)
+                result = response.get_json()
+                self.assertEqual(result['count'], 3)
+                items += [item['id'] for item in result['items']]
+                cursor_next = result.get('cursor_next')
+                if not cursor_next:
+                    break
+                self.assertTrue(base64.b64decode(cursor_next).startswith(
+                    b'keyset:'))
+            if sort == 'created':
+                # Timestamps can collide, in which case id breaks the tie
+                self.assertEqual(sorted(items), sorted(ids))
+            else:
+                self.assertEqual(items, ids)
+
+        # Offset-style cursors are still honored
+        cursor_next = base64.b64encode(b'cursor:2').decode('ascii')
+        response = self.call_endpoint(
+            '/list?sort=name&filter={"name":"page-%%"}&cursor_next=%s' % (
+                cursor_next), 'get')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['id'] for item in response.get_json()[
+            'items']], expected[2:])
+
+    def test_find_lists_invalid_cursor(self):
+        for cursor in (b'cursor:x', b'cursor', b'keyset:{"a', b'keyset:5',
+                       b'keyset:[1]', b'\xff\xfe', b'keyset:[[], "x"]'):
+            response = self.call_endpoint(
+                '/list?sort=name&cursor_next=%s' % quote(
+                    base64.b64encode(cursor).decode('ascii')), 'get')
+            self.assertEqual(response.status_code, 400, cursor)
+            self.assertEqual(response.get_json(), dict(
+                message='invalid cursor'))
+        response = self.call_endpoint('/list?cursor_next=%25%25', 'get')
+        self.assertEqual(response.status_code, 400)
+
+    def test_find_lists_count_strategies(self):
+        response = self.call_endpoint('/list?limit=1', 'get')
+        self.assertEqual(response.status_code, 200)
+        total = response.get_json()['count']
+        self.assertGreater(total, 1)
+        with self.config_overrides(pagination_count='window'):
+            response = self.call_endpoint('/list?limit=1', 'get')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json()['count'], total)
+        with self.config_overrides(pagination_count='estimate'):
+            response = self.call_endpoint('/list?limit=1', 'get')
+            self.assertEqual(response.get_json()['count'], total)
+            response = self.call_endpoint('/list', 'post', data=dict(
+                name='count-a', category_id=self.cat_id))
+            self.assertEqual(response.status_code, 201)
+
+            # The cached estimate is served until it expires
+            response = self.call_endpoint('/list?limit=1', 'get')
+            self.assertEqual(response.get_json()['count'], total)
+        response = self.call_endpoint('/list?limit=1', 'get')
+        self.assertEqual(response.get_json()['count'], total + 1)
@@ -134,3 +134,31 @@ class TestLocations(test_base.TestBase):
         result = response.get_json()['items']
         del result[0]['created']
         self.assertEqual(expected, result)
+
+    def test_delete_locations_set(self):
+        ids = []
+        for address in ('1 Main St', '2 Main St'):
+            response = self.call_endpoint('/location', 'post', data=dict(
+                address=address, city='Springfield', state='IL'))
+            self.assertEqual(response.status_code, 201)
+            ids.append(response.get_json()['id'])
+
+        # Nothing is removed if any record is not deletable
+        response = self.call_endpoint('/location/%s,%s,%s' % (
+            ids[0], self.location_id, ids[1]), 'delete')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.get_json()['id'], self.location_id)
+        response = self.call_endpoint('/location/%s' % ids[0], 'get')
+        self.assertEqual(response.get_json()['status'], 'active')
+
+        response = self.call_endpoint('/location/%s' % ','.join(ids),
+                                      'delete')
+        self.assertEqual(response.status_code, 204)
+        for id in ids:
+            response = self.call_endpoint('/trashcan/location-%s' % id, 'get')
+            self.assertEqual(response.status_code, 200)
+        response = self.call_endpoint('/trashcan/%s' % ','.join(
+            ['location-%s' % id for id in ids]), 'delete')
+        self.assertEqual(response.status_code, 204)
+        response = self.call_endpoint('/trashcan/location-%s' % ids[0], 'get')
+        self.assertEqual(response.status_code, 404)
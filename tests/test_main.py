@@ -5,9 +5,13 @@ Tests for top-level main app
 created 17-oct-2019 by richb@instantlinux.net
 """
 
+import redis
+from unittest import mock
+
 import test_base
 
 import apicrud._version as apiver
+from apicrud import initialize, state
 from example import _version
 
 
@@ -30,6 +34,16 @@ class TestMain(test_base.TestBase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.get_json(), expected)
 
+    def test_redis_unreachable(self):
+        with mock.patch.object(
+                state.redis_conn, 'ping',
+                side_effect=redis.exceptions.ConnectionError('down')), \
+                mock.patch.object(initialize, 'redis_verified', 0):
+            response = self.call_endpoint('/auth_methods', 'get')
+            self.assertEqual(response.status_code, 503)
+            response = self.call_endpoint('/health', 'get')
+            self.assertEqual(response.status_code, 200)
+
     def test_auth(self):
         expected = self.settings_id
         response = self.call_endpoint('/auth', 'post', data=dict(
@@ -5,10 +5,12 @@ Tests for external messaging
 created 18-jan-2021 by richb@instantlinux.net
 """
 
+from babel.support import Translations
 import smtplib
 from unittest import mock
 
-from apicrud import APIcrudSendError
+from apicrud import APIcrudFormatError, APIcrudSendError
+from apicrud.messaging.format import MessageFormat
 from apicrud.messaging.send import Messaging
 
 import test_base
@@ -33,6 +35,29 @@ class TestMessaging(test_base.TestBase):
         self.assertEqual('admin@test.conclave.events', _to)
         self.assertIn("List: test\n\nhello world", _body)
 
+    @mock.patch('smtplib.SMTP', autospec=True)
+    def test_send_refund(self, mock_smtp):
+        mock_smtp.return_value.sendmail.side_effect = (
+            smtplib.SMTPServerDisconnected('dropped'))
+        with mock.patch('apicrud.messaging.send.Metrics') as mock_metrics:
+            with self.assertRaises(smtplib.SMTPServerDisconnected):
+                Messaging().send(frm=self.test_uid, to=self.adm_contact_id,
+                                 template='moderator', list='test',
+                                 message='hello world')
+            mock_metrics.return_value.refund.assert_has_calls([
+                mock.call('email_daily_total', 1),
+                mock.call('email_monthly_total', 1)])
+
+            # Over the monthly limit: the daily credit is given back
+            mock_metrics.return_value.refund.reset_mock()
+            mock_metrics.return_value.store.side_effect = [True, False]
+            with self.assertRaises(APIcrudSendError):
+                Messaging().send(frm=self.test_uid, to=self.adm_contact_id,
+                                 template='moderator', list='test',
+                                 message='hello world')
+            mock_metrics.return_value.refund.assert_called_once_with(
+                'email_daily_total', 1)
+
     @mock.patch('smtplib.SMTP', autospec=True)
     def test_send_sms(self, mock_smtp):
         self.authorize()
@@ -188,3 +213,83 @@ class TestMessaging(test_base.TestBase):
         response = self.call_endpoint('/contact/%s' % self.adm_contact_2,
                                       'put', data=record)
         self.assertEqual(response.status_code, 200)
+
+    @mock.patch('apicrud.messaging.format.Translations.load',
+                wraps=Translations.load)
+    def test_format_environment_per_locale(self, mock_load):
+        formatter = MessageFormat(settings=mock.Mock())
+        MessageFormat._environments.pop('es', None)
+        directories = len(
+            self.config.BABEL_TRANSLATION_DIRECTORIES.split(';'))
+        for i in range(3):
+            body = formatter._render_template(
+                'moderator', 'es', selector='email', list='test',
+                message='hola')
+        self.assertEqual(mock_load.call_count, directories)
+        self.assertIn('Lista:', body)
+        self.assertIsNotNone(MessageFormat._environments[
+            'es'].bytecode_cache)
+        with self.assertRaises(APIcrudFormatError):
+            formatter._render_template('invalid', 'es', selector='email')
+
+        # Unrecognized locales share the default environment
+        environments = len(MessageFormat._environments)
+        for locale in ('xx_YY', '../../etc', 'zz-%d' % environments):
+            self.assertIs(formatter._environment(locale),
+                          formatter._environment(
+                              self.config.BABEL_DEFAULT_LOCALE))
+        self.assertLessEqual(len(MessageFormat._environments),
+                             environments + 1)
+
+    @mock.patch('smtplib.SMTP', autospec=True)
+    def test_send_bulk(self, mock_smtp):
+        messaging = Messaging()
+        with mock.patch.object(MessageFormat, '_render_template',
+                               side_effect=MessageFormat._render_template,
+                               autospec=True) as mock_render:
+            sent = messaging.send_bulk(
+                [self.adm_contact_id, self.adm_contact_2, 'x-notfound'],
+                'moderator', frm=self.test_uid, to_uids=[self.test_uid],
+                list='bulk', message='to everyone')
+        self.assertEqual(sent, 3)
+        mock_smtp.assert_called_once()
+        calls = [name for name, args, kwargs in mock_smtp.method_calls]
+        self.assertEqual(calls, ['().starttls'] + ['().sendmail'] * 3)
+        self.assertEqual(
+            set(call.args[1] for call in mock_smtp.mock_calls
+                if call[0] == '().sendmail'),
+            set(['admin@test.conclave.events', self.test_email,
+                 'hidden-adm@test.conclave.events']))
+        for call in mock_smtp.mock_calls:
+            if call[0] == '().sendmail':
+                self.assertIn('List: bulk\n\nto everyone', call.args[2])
+
+        # Subject, text and html are rendered once; footers per recipient
+        templates = [call.args[1] for call in mock_render.call_args_list]
+        self.assertEqual(templates.count('moderator'), 3)
+        self.assertEqual(templates.count('footer'), 6)
+
+        # Usage is metered in one batch, limited by remaining credit
+        with mock.patch('apicrud.messaging.send.Metrics') as mock_metrics:
+            mock_metrics.return_value.reserve.side_effect = [2, 1]
+            self.assertEqual(messaging.send_bulk(
+                [self.adm_contact_id, self.adm_contact_2], 'moderator',
+                frm=self.test_uid, list='bulk', message='over quota'), 1)
+        mock_metrics.return_value.reserve.assert_has_calls([
+            mock.call('email_daily_total', 2),
+            mock.call('email_monthly_total', 2)])
+        mock_metrics.return_value.refund.assert_called_once_with(
+            'email_daily_total', 1)
+
+        # A recipient refused by the smarthost doesn't stop the batch,
+        #  and its daily and monthly credit is given back
+        mock_smtp.return_value.sendmail.side_effect = [
+            smtplib.SMTPDataError(554, 'rejected'), {}]
+        with mock.patch('apicrud.messaging.send.Metrics') as mock_metrics:
+            mock_metrics.return_value.reserve.side_effect = [2, 2]
+            self.assertEqual(messaging.send_bulk(
+                [self.adm_contact_id, self.adm_contact_2], 'moderator',
+                frm=self.test_uid, list='bulk', message='refused'), 1)
+        mock_metrics.return_value.refund.assert_has_calls([
+            mock.call('email_daily_total', 1),
+            mock.call('email_monthly_total', 1)])
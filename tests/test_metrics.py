@@ -4,8 +4,14 @@ Tests for metrics
 
 created 23-feb-2021 by richb@instantlinux.net
 """
+from concurrent.futures import ThreadPoolExecutor
+import redis
+from unittest import mock
+
 import test_base
-from apicrud import database, Metrics
+from apicrud import database, Metrics, ServiceRegistry
+from apicrud.metrics import BACKFILL_KEY, BACKFILL_LOCK, PRUNE_SCRIPT
+from apicrud.redis_pool import call_script
 
 
 class TestMetrics(test_base.TestBase):
@@ -40,6 +46,75 @@ class TestMetrics(test_base.TestBase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.get_json()['items'][0]['value'], value + 3)
 
+    def test_request_buffer_flush(self):
+        metrics = Metrics()
+        key = 'mtr:api_calls_total:resource=buffered'
+        with self.app.test_request_context():
+            metrics.buffer()
+            metrics.store('api_calls_total', labels=['resource=buffered'])
+            metrics.store('api_calls_total', labels=['resource=buffered'],
+                          value=2)
+            self.assertIsNone(self.redis.get(key))
+            metrics.flush()
+            self.assertEqual(int(self.redis.get(key)), 3)
+
+            # Without a buffer, metrics are stored immediately
+            metrics.store('api_calls_total', labels=['resource=buffered'])
+            self.assertEqual(int(self.redis.get(key)), 4)
+        self.redis.delete(key)
+
+    def test_indexed_lookup(self):
+        Metrics().store('api_calls_total', labels=['resource=indexed'])
+        self.redis.sadd('mti:api_calls_total', 'resource=expired')
+        with mock.patch.object(self.redis, 'scan_iter') as mock_scan:
+            response = self.call_endpoint(
+                '/metric?filter={"name":"api_calls_total",'
+                '"label":"resource=indexed"}', 'get')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json()['items'], [dict(
+                name='api_calls_total', labels=['resource=indexed'],
+                value=1)])
+            response = self.call_endpoint('/metrics', 'get')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('api_calls_total{resource="indexed"} 1\n',
+                          response.data.decode())
+            mock_scan.assert_not_called()
+        self.assertFalse(self.redis.sismember('mti:api_calls_total',
+                                              'resource=expired'))
+        self.redis.delete('mtr:api_calls_total:resource=indexed')
+
+    def test_index_backfill(self):
+        key = 'mtr:api_calls_total:resource=legacy'
+        self.redis.set(key, 5)
+        self.redis.delete(BACKFILL_KEY)
+
+        # A backfill that fails partway is not marked done
+        with mock.patch('redis.client.Pipeline.execute',
+                        side_effect=redis.exceptions.ConnectionError):
+            with self.assertRaises(redis.exceptions.ConnectionError):
+                Metrics().backfill_index()
+        self.assertFalse(self.redis.exists(BACKFILL_KEY))
+        self.redis.delete(BACKFILL_LOCK)
+
+        Metrics().backfill_index()
+        self.assertTrue(self.redis.sismember('mti:api_calls_total',
+                                             'resource=legacy'))
+        self.assertTrue(self.redis.exists(BACKFILL_KEY))
+        self.assertFalse(self.redis.exists(BACKFILL_LOCK))
+
+        # Only runs once; an index entry whose series exists is kept
+        self.redis.srem('mti:api_calls_total', 'resource=legacy')
+        Metrics().backfill_index()
+        self.assertFalse(self.redis.sismember('mti:api_calls_total',
+                                              'resource=legacy'))
+        self.redis.sadd('mti:api_calls_total', 'resource=legacy')
+        call_script(
+            self.redis, PRUNE_SCRIPT, keys=['mti:api_calls_total', key],
+            args=['resource=legacy'])
+        self.assertTrue(self.redis.sismember('mti:api_calls_total',
+                                             'resource=legacy'))
+        self.redis.delete(key)
+
     def test_prometheus_collect(self):
         response = self.call_endpoint('/metrics', 'get')
         self.assertEqual(response.status_code, 200)
@@ -48,11 +123,32 @@ class TestMetrics(test_base.TestBase):
         self.assertIn("api_request_seconds_total{", result)
         self.assertIn("# TYPE process_virtual_memory_bytes gauge\n"
                       "process_virtual_memory_bytes{instance=", result)
+        self.assertTrue(response.mimetype.startswith('text/plain'))
+        types = [line.split()[2] for line in result.splitlines()
+                 if line.startswith('# TYPE')]
+        self.assertEqual(len(types), len(set(types)))
 
         response = self.call_endpoint('/metrics?limit=1', 'get')
         self.assertEqual(response.status_code, 200)
         self.assertLessEqual(response.data.decode().count('n'), 3)
 
+    def test_prometheus_help_and_escape(self):
+        metric = dict(api_calls_total=dict(
+            scope='instance', style='counter', help='API calls'))
+        Metrics().store('api_calls_total', labels=['resource=a"b'])
+        Metrics().store('api_calls_total', labels=['resource=c'])
+        with self.config_overrides(metrics=metric):
+            response = self.call_endpoint(
+                '/metrics?filter={"name":"api_calls_total"}', 'get')
+        self.assertEqual(response.status_code, 200)
+        result = response.data.decode()
+        self.assertEqual(result.count('# HELP api_calls_total API calls\n'
+                                      '# TYPE api_calls_total counter\n'), 1)
+        self.assertIn('api_calls_total{resource="a\\"b"} 1\n', result)
+        self.assertIn('api_calls_total{resource="c"} 1\n', result)
+        self.redis.delete('mtr:api_calls_total:resource=a"b',
+                          'mtr:api_calls_total:resource=c')
+
     def test_find_several(self):
         response = self.call_endpoint('/metric?offset=2&limit=5', 'get')
         self.assertEqual(response.status_code, 200)
@@ -165,3 +261,144 @@ class TestMetrics(test_base.TestBase):
             self.assertEqual(response.status_code, 200)
             self.assertEqual(response.get_json().get('items'), [
                 dict(labels=['uid=%s' % self.test_uid], name=grant, value=0)])
+
+    def test_grant_concurrent_store(self):
+        grant = 'photo_res_max'
+        limit = 5
+        metric = {grant: {'style': 'grant'}}
+
+        db_session = database.get_session(db_url=self.config.DB_URL)
+        with self.config_overrides(metrics=metric):
+            metrics = Metrics(uid=self.admin_uid, db_session=db_session)
+            with mock.patch('apicrud.metrics.Grants') as mock_grants:
+                mock_grants.return_value.get.return_value = limit
+                with ThreadPoolExecutor(max_workers=4) as executor:
+                    results = list(executor.map(
+                        lambda i: metrics.store(grant), range(limit * 2)))
+            self.assertEqual(results.count(True), limit)
+            self.assertIsNone(metrics.check(grant))
+        self.redis.delete('mtr:%s:uid=%s' % (grant, self.admin_uid))
+        db_session.remove()
+
+    def test_grant_reserve(self):
+        grant = 'photo_res_max'
+        metric = {grant: {'style': 'grant'}}
+
+        db_session = database.get_session(db_url=self.config.DB_URL)
+        with self.config_overrides(metrics=metric):
+            metrics = Metrics(uid=self.admin_uid, db_session=db_session)
+            with mock.patch('apicrud.metrics.Grants') as mock_grants:
+                mock_grants.return_value.get.return_value = 5
+                self.assertEqual(metrics.reserve(grant, 3), 3)
+                self.assertEqual(metrics.reserve(grant, 3), 2)
+                self.assertEqual(metrics.reserve(grant, 1), 0)
+                self.assertEqual(metrics.reserve(grant, 0), 0)
+                self.assertFalse(metrics.store(grant))
+                metrics.refund(grant, 2)
+                self.assertEqual(metrics.reserve(grant, 3), 2)
+            with self.assertRaises(AssertionError):
+                metrics.reserve('api_calls_total', 1)
+        self.redis.delete('mtr:%s:uid=%s' % (grant, self.admin_uid))
+        db_session.remove()
+
+    def test_histogram_summary(self):
+        metric = dict(
+            latency_seconds=dict(scope='instance', style='histogram',
+                                 buckets=[0.1, 1]),
+            size_bytes=dict(scope='instance', style='summary'))
+        with self.config_overrides(metrics=metric, metrics_flush_interval=60):
+            metrics = Metrics()
+            labels = 'method=GET,resource=person,status=200'
+            for value in (0.05, 0.5, 0.7, 3):
+                metrics.store('latency_seconds', labels=labels.split(','),
+                              value=value)
+            metrics.store('size_bytes', labels=['resource=person'],
+                          value=1024)
+            with self.assertRaises(AssertionError):
+                metrics.store('size_bytes', labels=['resource=person'])
+
+            # Observations stay in process until flushed
+            self.assertFalse(self.redis.exists(
+                'mtr:latency_seconds:%s' % labels))
+            with self.app.test_request_context():
+                metrics.flush()
+            self.assertFalse(self.redis.exists(
+                'mtr:latency_seconds:%s' % labels))
+
+            response = self.call_endpoint(
+                '/metrics?filter={"name":"latency_seconds"}', 'get')
+            self.assertEqual(response.status_code, 200)
+            result = response.data.decode()
+            response = self.call_endpoint(
+                '/metrics?filter={"name":"size_bytes"}', 'get')
+            result += response.data.decode()
+            pairs = 'method="GET",resource="person",status="200"'
+            self.assertIn(
+                '# TYPE latency_seconds histogram\n'
+                'latency_seconds_bucket{%s,le="0.1"} 1\n'
+                'latency_seconds_bucket{%s,le="1.0"} 3\n'
+                'latency_seconds_bucket{%s,le="+Inf"} 4\n'
+                'latency_seconds_sum{%s} 4.25\n'
+                'latency_seconds_count{%s} 4\n' % ((pairs,) * 5), result)
+            self.assertIn(
+                '# TYPE size_bytes summary\n'
+                'size_bytes_sum{resource="person"} 1024\n'
+                'size_bytes_count{resource="person"} 1\n', result)
+        self.redis.delete('mtr:latency_seconds:%s' % labels,
+                          'mtr:size_bytes:resource=person')
+
+    def test_observations_kept_on_failure(self):
+        metric = dict(size_bytes=dict(scope='instance', style='summary'))
+        key = 'mtr:size_bytes:resource=file'
+        with self.config_overrides(metrics=metric, metrics_flush_interval=0):
+            metrics = Metrics()
+            metrics.store('size_bytes', labels=['resource=file'], value=512)
+            with mock.patch('redis.client.Pipeline.execute',
+                            side_effect=redis.exceptions.ConnectionError):
+                with self.assertRaises(redis.exceptions.ConnectionError):
+                    metrics.flush()
+            metrics.store('size_bytes', labels=['resource=file'], value=256)
+            self.assertFalse(self.redis.exists(key))
+
+            # The sampler thread flushes outside of any request
+            metrics._sample()
+            self.assertEqual(self.redis.hgetall(key),
+                             {b'count': b'2', b'sum': b'768'})
+        self.redis.delete(key)
+
+    def test_request_latency_histogram(self):
+        with self.config_overrides(metrics_flush_interval=0):
+            response = self.call_endpoint('/settings/x-75023275', 'get')
+            self.assertEqual(response.status_code, 200)
+            response = self.call_endpoint(
+                '/metric?filter={"name":"api_request_seconds",'
+                '"label":"resource=settings"}', 'get')
+        self.assertEqual(response.status_code, 200)
+        item = [item for item in response.get_json()['items']
+                if 'method=GET' in item['labels']][0]
+        self.assertIn('status=200', item['labels'])
+        self.assertGreaterEqual(item['value']['count'], 1)
+        self.assertIn('sum', item['value'])
+
+    def test_process_sampler(self):
+        key = 'mtr:process_open_fds:instance=%s' % (
+            ServiceRegistry().get()['id'])
+        with mock.patch.object(Metrics, '_sampler_pid', None), \
+                mock.patch('threading.Thread') as mock_thread:
+            self.redis.delete(key)
+            Metrics().start_sampler()
+            self.assertTrue(self.redis.exists(key))
+            self.assertTrue(self.redis.exists(
+                key.replace('process_open_fds', 'redis_pool_connections_max')))
+            Metrics().start_sampler()
+            mock_thread.assert_called_once()
+            self.assertEqual(mock_thread.call_args.kwargs['args'],
+                             (self.config.METRICS_PROCESS_INTERVAL,))
+
+        # Find and collect only read
+        with mock.patch.object(Metrics, '_process_collect') as mock_collect:
+            response = self.call_endpoint('/metric', 'get')
+            self.assertEqual(response.status_code, 200)
+            response = self.call_endpoint('/metrics', 'get')
+            self.assertEqual(response.status_code, 200)
+            mock_collect.assert_not_called()
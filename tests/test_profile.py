@@ -5,7 +5,10 @@ Tests for profile controller
 created 22-aug-2020 by richb@instantlinux.net
 """
 
+from sqlalchemy import event
+
 import test_base
+from apicrud import database, ProfileCache
 
 
 class TestProfile(test_base.TestBase):
@@ -114,3 +117,36 @@ class TestProfile(test_base.TestBase):
                          % response.get_json().get('message'))
         self.assertEqual(response.get_json()['message'],
                          'duplicate or other conflict')
+
+    def test_profile_cache(self):
+        db_session = database.get_session()
+        cache = ProfileCache(db_session)
+        self.assertIsNone(cache.get(self.test_uid, 'lang'))
+        ProfileCache.uncache(self.test_uid)
+        ProfileCache.uncache(self.admin_uid)
+        queries = []
+
+        def _count(conn, cursor, statement, *args):
+            queries.append(statement)
+
+        event.listen(db_session.get_bind(), 'before_cursor_execute', _count)
+        self.assertEqual(cache.load([self.test_uid, self.admin_uid]).keys(),
+                         set([self.test_uid, self.admin_uid]))
+        cache.get(self.admin_uid)
+        self.assertEqual(len(queries), 1)
+        event.remove(db_session.get_bind(), 'before_cursor_execute', _count)
+
+        record = dict(item='lang', value='de_DE', uid=self.test_uid)
+        response = self.call_endpoint('/profile', 'post', data=record)
+        self.assertEqual(response.status_code, 201)
+        id = response.get_json()['id']
+        self.assertEqual(cache.get(self.test_uid, 'lang'), 'de_DE')
+        response = self.call_endpoint('/profile/%s' % id, 'put', data=dict(
+            record, value='it_IT'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(cache.get(self.test_uid, 'lang'), 'it_IT')
+        response = self.call_endpoint('/profile/%s?force=true' % id,
+                                      'delete')
+        self.assertEqual(response.status_code, 204)
+        self.assertIsNone(cache.get(self.test_uid, 'lang'))
+        db_session.remove()
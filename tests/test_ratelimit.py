@@ -11,7 +11,7 @@ from redis.exceptions import ConnectionError, DataError
 from unittest import mock
 
 import test_base
-from apicrud import database, RateLimit
+from apicrud import ClientLimit, database, RateLimit
 
 
 class TestRateLimit(test_base.TestBase):
@@ -45,6 +45,8 @@ class TestRateLimit(test_base.TestBase):
             response = self.call_endpoint('/account/%s' % acc.id, 'get')
             self.assertEqual(response.status_code, 429, 'expecting rate-limit')
             self.assertEqual(response.get_json(), expected)
+            self.assertEqual(response.headers['X-RateLimit-Remaining'], '0')
+            self.assertIn('Retry-After', response.headers)
 
             # Turn off rate-limiting and re-try
             with self.config_overrides(ratelimit_enable=False):
@@ -52,9 +54,8 @@ class TestRateLimit(test_base.TestBase):
                 self.assertEqual(response.status_code, 200)
 
     @mock.patch('logging.error')
-    @mock.patch('redis.Redis.pipeline')
-    @mock.patch('redis.Redis.get')
-    def test_ratelimit_exceptions(self, mock_get, mock_pipeline, mock_error):
+    @mock.patch('redis.Redis.evalsha')
+    def test_ratelimit_exceptions(self, mock_evalsha, mock_error):
 
         with self.app.test_request_context():
             g.db = database.get_session()
@@ -62,14 +63,84 @@ class TestRateLimit(test_base.TestBase):
             self.assertFalse(RateLimit().call(uid=None),
                              msg='Anonymous requests should not be limited')
 
-            mock_get.side_effect = ConnectionError('testlimit')
+            mock_evalsha.side_effect = ConnectionError('testlimit')
             self.assertFalse(RateLimit().call(uid=self.test_uid))
             mock_error.assert_called_with(dict(action='ratelimit.call',
                                                message='testlimit'))
-            mock_get.side_effect = None
 
-            mock_pipeline.side_effect = DataError('key not set')
+            mock_evalsha.side_effect = DataError('key not set')
             self.assertFalse(RateLimit().call(uid=self.test_uid))
             mock_error.assert_called_with(dict(action='ratelimit.call',
                                                message='key not set'))
             g.db.remove()
+
+    def test_algorithms(self):
+        limit = 4
+        uid = 'u-ratelimit'
+        with self.app.test_request_context():
+            for algorithm in ('gcra', 'sliding'):
+                ratelimit = RateLimit(interval=60, algorithm=algorithm)
+                for call in range(limit):
+                    self.assertFalse(ratelimit.call(
+                        limit=limit, service='test', uid=uid))
+                    self.assertEqual(ratelimit.remaining, limit - call - 1)
+                self.assertEqual(ratelimit.headers(), {
+                    'X-RateLimit-Limit': str(limit),
+                    'X-RateLimit-Remaining': '0',
+                    'X-RateLimit-Reset': '60'})
+                self.assertTrue(ratelimit.call(
+                    limit=limit, service='test', uid=uid), msg=algorithm)
+                headers = ratelimit.headers()
+                self.assertEqual(headers['X-RateLimit-Remaining'], '0')
+                self.assertLessEqual(int(headers['Retry-After']), 60)
+                ratelimit.reset(service='test', uid=uid)
+                self.assertFalse(ratelimit.call(
+                    limit=limit, service='test', uid=uid))
+                ratelimit.reset(service='test', uid=uid)
+
+    def test_client_limit(self):
+        address = '192.0.2.1'
+        with self.app.test_request_context():
+            limiter = ClientLimit(rate=0.5, burst=3)
+            for call in range(3):
+                self.assertFalse(limiter.call(address=address))
+            self.assertTrue(limiter.call(address=address))
+            self.assertIn(limiter.headers()['Retry-After'], ('1', '2'))
+            self.assertFalse(ClientLimit(rate=0.5, burst=3).call(
+                address='192.0.2.2'))
+
+            with self.config_overrides(ratelimit_enable=False):
+                self.assertFalse(ClientLimit(rate=0.5, burst=3).call(
+                    address=address))
+
+        # Anonymous requests are shed per forwarded client address;
+        # health probes and authenticated users are exempt
+        with self.config_overrides(ratelimit_client_burst=1,
+                                   ratelimit_client_rate=0.01):
+            ClientLimit._buckets.clear()
+            response = self.call_endpoint(
+                '/auth_methods', 'get',
+                extraheaders={'X-Forwarded-For': '203.0.113.1'})
+            self.assertEqual(response.status_code, 200)
+            with mock.patch('apicrud.initialize.SessionManager') as mock_ses:
+                response = self.call_endpoint(
+                    '/auth_methods', 'get',
+                    extraheaders={'X-Forwarded-For': '203.0.113.1'})
+                mock_ses.assert_not_called()
+            self.assertEqual(response.status_code, 429)
+            self.assertIn('Retry-After', response.headers)
+            self.assertIn('203.0.113.1', ClientLimit._buckets)
+            response = self.call_endpoint(
+                '/auth_methods', 'get',
+                extraheaders={'X-Forwarded-For': '203.0.113.2'})
+            self.assertEqual(response.status_code, 200)
+            response = self.call_endpoint(
+                '/health', 'get',
+                extraheaders={'X-Forwarded-For': '203.0.113.1'})
+            self.assertNotEqual(response.status_code, 429)
+            self.authorize()
+            response = self.call_endpoint(
+                '/person', 'get',
+                extraheaders={'X-Forwarded-For': '203.0.113.1'})
+            self.assertEqual(response.status_code, 200)
+        ClientLimit._buckets.clear()
@@ -0,0 +1,50 @@
+"""test_redis_pool
+
+Tests for redis connection pool
+"""
+
+import redis
+from unittest import mock
+
+import test_base
+from apicrud import Mutex
+from apicrud.redis_pool import call_script, pool_stats, redis_connect
+
+
+class TestRedisPool(test_base.TestBase):
+
+    def test_shared_pool(self):
+        with self.config_overrides(redis_max_connections=7,
+                                   redis_pool_timeout=3,
+                                   redis_socket_timeout=2):
+            conn = redis_connect(host='redis-pool-test')
+            self.assertIs(conn.connection_pool, redis_connect(
+                host='redis-pool-test').connection_pool)
+            self.assertIs(conn.connection_pool, Mutex(
+                'test', redis_host='redis-pool-test').connection.
+                connection_pool)
+            self.assertIsInstance(conn.connection_pool,
+                                  redis.BlockingConnectionPool)
+            self.assertEqual(conn.connection_pool.timeout, 3)
+            kwargs = conn.connection_pool.connection_kwargs
+            self.assertEqual(kwargs['host'], 'redis-pool-test')
+            self.assertEqual(kwargs['socket_timeout'], 2)
+            self.assertEqual(pool_stats(conn), dict(
+                available=0, created=0, in_use=0, max=7))
+
+    def test_unix_socket(self):
+        with self.config_overrides(redis_unix_socket='/run/redis.sock'):
+            conn = redis_connect(host='redis-socket-test')
+            self.assertIs(conn.connection_pool.connection_class,
+                          redis.UnixDomainSocketConnection)
+            self.assertEqual(conn.connection_pool.connection_kwargs['path'],
+                             '/run/redis.sock')
+
+    def test_script_registered_once(self):
+        script = 'return ARGV[1]'
+        with mock.patch.object(self.redis, 'register_script',
+                               wraps=self.redis.register_script) as mock_reg:
+            for i in range(3):
+                self.assertEqual(call_script(self.redis, script, args=[i]),
+                                 str(i).encode())
+        mock_reg.assert_called_once()
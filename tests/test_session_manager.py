@@ -0,0 +1,68 @@
+"""test_session_manager
+
+Tests for session manager
+"""
+
+import json
+import redis
+import time
+from unittest import mock
+
+import test_base
+from apicrud import SessionManager
+
+
+class TestSessionManager(test_base.TestBase):
+
+    def test_session_local_cache(self):
+        with self.config_overrides(session_cache_size=10):
+            ses = SessionManager(redis_conn=self.redis)
+            content = ses.create('u-cached01', ['user'], acc='x-cached01')
+            token = content['jti']
+            self.assertEqual(ses.get('u-cached01', token, arg='acc'),
+                             'x-cached01')
+            with mock.patch.object(ses.connection, 'get') as mock_get:
+                self.assertEqual(ses.get('u-cached01', token), content)
+                self.assertEqual(ses.get('u-cached01', 'x' + token), None)
+                mock_get.assert_not_called()
+
+            # Callers get their own copy of a cached session
+            ses.get('u-cached01', token)['acc'] = 'changed'
+            self.assertEqual(ses.get('u-cached01', token, arg='acc'),
+                             'x-cached01')
+
+            ses.update('u-cached01', token, 'auth', 'user:admin')
+            self.assertEqual(ses.get('u-cached01', token, arg='auth'),
+                             'user:admin')
+
+            # Changes published by another worker evict the cached copy
+            key = 'ses:u-cached01:%s' % token[-3:]
+            self.redis.set(key, ses.aes.encrypt(json.dumps(
+                dict(content, auth='pending'))))
+            self.redis.publish(SessionManager.channel, key)
+            for i in range(20):
+                if ses.get('u-cached01', token, arg='auth') == 'pending':
+                    break
+                time.sleep(0.1)
+            self.assertEqual(ses.get('u-cached01', token, arg='auth'),
+                             'pending')
+
+            ses.delete('u-cached01', token)
+            self.assertIsNone(ses.get('u-cached01', token))
+
+    def test_subscriber_restarted(self):
+        with self.config_overrides(session_cache_size=10):
+            SessionManager(redis_conn=self.redis)
+            SessionManager._thread.stop()
+            SessionManager._thread.join(timeout=5)
+            with mock.patch.object(
+                    redis.client.PubSub, 'subscribe',
+                    side_effect=redis.exceptions.ConnectionError('down')):
+                ses = SessionManager(redis_conn=self.redis)
+                self.assertIsNone(SessionManager._cache)
+                content = ses.create('u-cached02', ['user'])
+                self.assertEqual(ses.get('u-cached02', content['jti']),
+                                 content)
+            SessionManager(redis_conn=self.redis)
+            self.assertTrue(SessionManager._thread.is_alive())
+            self.assertIsNotNone(SessionManager._cache)